@@ -0,0 +1,173 @@
+'''
+Database backends for querying the OAI database: a PostgreSQL server, or
+an embedded database file built by createdb.py --backend duckdb|sqlite.
+Embedded databases keep column descriptions in a colcomments table.
+'''
+import os
+import sqlite3
+import itertools
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# -------------------------------------------------------------------
+# By default psycopg2 converts postgresql decimal/numeric types to
+# Python Decimal objects. This code forces a float type cast instead
+# (only NUMERIC columns of databases built before createdb.py inferred 
+# SMALLINT/INTEGER/REAL/DOUBLE PRECISION types pay for this)
+if psycopg2:
+    DEC2FLOAT = psycopg2.extensions.new_type(
+        psycopg2.extensions.DECIMAL.values,
+        'DEC2FLOAT',
+        lambda value, curs: float(value) if value is not None else None)
+    psycopg2.extensions.register_type(DEC2FLOAT)
+# -------------------------------------------------------------------
+
+# names of server-side cursors
+STREAM_IDS = itertools.count()
+
+# embedded database file extensions
+FILE_BACKENDS = {".duckdb":"duckdb", ".sqlite":"sqlite", ".sqlite3":"sqlite",
+                 ".db":"sqlite"}
+
+
+class PostgresBackend(object):
+    '''PostgreSQL server; dbname is a database name or a libpq connection
+    string (e.g., "host=db dbname=oai2 user=oai" or "postgresql://db/oai2")
+    '''
+    name = "postgres"
+
+    def connect(self, dbname):
+        if "=" in dbname or "://" in dbname:
+            return psycopg2.connect(dbname)
+        return psycopg2.connect(database=dbname, user='')
+
+    def ping(self, con):
+        cur = con.cursor()
+        cur.execute("SELECT 1;")
+        cur.fetchall()
+        con.rollback()
+
+    def alive(self, con):
+        return not con.closed
+
+    def release(self, con):
+        con.rollback()
+
+    def stream_cursor(self, con, itersize):
+        '''Server-side (named) cursor, fetching itersize rows per round-trip
+        '''
+        cur = con.cursor(name="oai_stream_%d" % next(STREAM_IDS))
+        cur.itersize = itersize
+        return cur
+
+    def table_names_query(self):
+
+        sql = "SELECT DISTINCT(table_name) FROM information_schema.columns"
+        sql += " WHERE table_schema='public';"
+        return sql
+
+    def columns_query(self):
+
+        sql = "SELECT table_name, column_name FROM information_schema.columns"
+        sql += " WHERE table_schema='public';"
+        return sql
+
+    def descriptions_query(self):
+        '''Comments of all table columns
+        '''
+        return """SELECT c.relname, a.attname, d.description
+   FROM pg_description As d
+    INNER JOIN pg_class As c ON c.oid = d.objoid
+    INNER JOIN pg_attribute As a ON (a.attrelid = c.oid AND a.attnum = d.objsubid)
+    INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+   WHERE n.nspname = 'public' AND d.objsubid > 0;
+    """
+
+
+class DuckDBBackend(object):
+    '''DuckDB database file (opened read-only, so several processes can
+    query it at once)
+    '''
+    name = "duckdb"
+
+    def connect(self, dbname):
+        return duckdb.connect(dbname, read_only=True)
+
+    def ping(self, con):
+        con.execute("SELECT 1;").fetchall()
+
+    def alive(self, con):
+        return True
+
+    def release(self, con):
+        # read-only connections never hold a transaction open
+        pass
+
+    def stream_cursor(self, con, itersize):
+        '''Embedded databases produce rows as they are fetched
+        '''
+        return con.cursor()
+
+    def table_names_query(self):
+
+        sql = "SELECT DISTINCT(lower(table_name)) FROM information_schema.columns"
+        sql += " WHERE table_schema='main';"
+        return sql
+
+    def columns_query(self):
+
+        sql = "SELECT lower(table_name), column_name FROM information_schema.columns"
+        sql += " WHERE table_schema='main';"
+        return sql
+
+    def descriptions_query(self):
+
+        return "SELECT table_name, column_name, description FROM colcomments;"
+
+
+class SQLiteBackend(DuckDBBackend):
+    '''SQLite database file
+    '''
+    name = "sqlite"
+
+    def connect(self, dbname):
+        # pooled connections may be used by any thread, one at a time
+        return sqlite3.connect(dbname, check_same_thread=False)
+
+    def release(self, con):
+        con.rollback()
+
+    def table_names_query(self):
+        return "SELECT lower(name) FROM sqlite_master WHERE type='table';"
+
+    def columns_query(self):
+
+        sql = "SELECT lower(m.name), p.name FROM sqlite_master AS m"
+        sql += " JOIN pragma_table_info(m.name) AS p WHERE m.type IN ('table','view');"
+        return sql
+
+
+BACKENDS = {"postgres":PostgresBackend(), "duckdb":DuckDBBackend(),
+            "sqlite":SQLiteBackend()}
+
+def get_backend(dbname, backend=None):
+    '''Backend by name or, if not given, by database file extension (any
+    other dbname is a PostgreSQL database)
+    '''
+    if backend == None:
+        ext = "" if "://" in dbname else os.path.splitext(dbname)[1].lower()
+        backend = FILE_BACKENDS.get(ext, "postgres")
+
+    return BACKENDS[backend]
+
+def connect(dbname, backend=None):
+
+    return get_backend(dbname, backend).connect(dbname)
@@ -0,0 +1,82 @@
+'''
+Binary COPY fetch engine for PostgreSQL. Query results are streamed with
+
+  COPY (SELECT ...) TO STDOUT WITH (FORMAT binary)
+
+and decoded in bulk into NumPy column arrays, without creating a Python
+object per value. Every column is cast to a fixed width type (float8 or
+int8) with NULLs replaced in the query (NaN for floats, NULL_INT for ints),
+so all rows have the same binary layout and the whole stream is read as
+one structured array.
+'''
+import cStringIO
+import numpy as np
+
+# binary COPY file header signature
+SIGNATURE = "PGCOPY\n\xff\r\n\x00"
+
+# int columns: value of NULLs
+NULL_INT = np.iinfo(np.int64).min
+
+CASTS = {"float":"COALESCE(CAST(%s AS float8), CAST('NaN' AS float8))",
+         "int":"COALESCE(CAST(%s AS int8), CAST('" + str(NULL_INT) + "' AS int8))"}
+
+
+def copy_sql(table, columns, kinds, where=None):
+    '''COPY statement fetching columns (of kind "float" or "int") from table
+    '''
+    exprs = [CASTS[kind] % col for col,kind in zip(columns,kinds)]
+    query = "SELECT %s FROM %s" % (",".join(exprs), table)
+    if where:
+        query += " WHERE %s" % where
+    return "COPY (%s) TO STDOUT WITH (FORMAT binary)" % query
+
+def row_dtype(n):
+    '''Binary COPY layout of a row of n 8 byte fields: field count, then a
+    length and a value per field (all big-endian)
+    '''
+    fields = [("n",">i2")]
+    for j in range(n):
+        fields += [("len%d" % j,">i4"), ("val%d" % j,">u8")]
+    return np.dtype(fields)
+
+def decode(data, kinds):
+    '''Decode a binary COPY stream of fixed width columns. Returns a list of
+    float64 or int64 arrays.
+    '''
+    if data[:len(SIGNATURE)] != SIGNATURE:
+        raise ValueError("not a binary COPY stream")
+
+    # header: signature, flags and header extension
+    offset = len(SIGNATURE) + 4
+    offset += 4 + np.frombuffer(data, dtype=">i4", count=1, offset=offset)[0]
+
+    # rows, followed by a -1 field count trailer
+    dtype = row_dtype(len(kinds))
+    body = len(data) - offset - 2
+    if body < 0 or body % dtype.itemsize:
+        raise ValueError("unexpected binary COPY row layout")
+
+    rows = np.frombuffer(data, dtype=dtype, count=body / dtype.itemsize, offset=offset)
+    if (rows["n"] != len(kinds)).any():
+        raise ValueError("unexpected binary COPY field count")
+
+    cols = []
+    for j,kind in enumerate(kinds):
+        if (rows["len%d" % j] != 8).any():
+            raise ValueError("unexpected binary COPY field width")
+        col = rows["val%d" % j].astype(np.uint64)
+        cols += [col.view(np.float64 if kind == "float" else np.int64)]
+
+    return cols
+
+def copy_columns(con, table, columns, kinds, where=None):
+    '''Fetch columns of table with binary COPY on psycopg2 connection con.
+    Returns a list of NumPy arrays, one per column.
+    '''
+    stream = cStringIO.StringIO()
+    cur = con.cursor()
+    cur.copy_expert(copy_sql(table, columns, kinds, where), stream)
+    cur.close()
+
+    return decode(stream.getvalue(), kinds)
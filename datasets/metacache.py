@@ -0,0 +1,39 @@
+'''
+Reader for the parsed variable guide cache written by
+utils/dbimport/metadata.py --cache. Variable definitions and categories
+are available without a database connection.
+
+The cache header also holds the checksum of the variable guide it was
+parsed from. It is only used by metadata.py to decide whether to reparse;
+it isn't checked here, so a cache built from another guide than the one 
+the database was loaded from is read without complaint.
+'''
+import cPickle as pickle
+
+# cache file format, also written by utils/dbimport/metadata.py
+CACHE_VERSION = 1
+
+def load_metadata_cache(filename):
+    '''Return dictionary of var_id -> variable definition, holding the same
+    (lower case) values as the vardefs, varcategories and categorydefs tables
+    built from the same variable guide
+    '''
+    with open(filename,"rb") as f:
+        header = pickle.load(f)
+        if header.get("version") != CACHE_VERSION:
+            raise ValueError("unsupported metadata cache version %s" % header.get("version"))
+        metadata = pickle.load(f)
+
+    vardefs = {}
+    for var_name,md in metadata.items():
+        vardefs[var_name.lower()] = {
+            "type":md["type"].lower(),
+            "labeln":md["label_n"],
+            "labelset":None if md["values"] == None else md["values"].lower(),
+            "dataset":md["dataset"].lower(),
+            "collect_form":md["collection"].lower(),
+            "comment":None if md["comments"] == "None" else md["comments"].lower(),
+            "category":sorted([x.lower() for x in md["category"]]),
+            "subcategory":sorted([x.lower() for x in md["subcategory"]])}
+
+    return vardefs
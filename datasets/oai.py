@@ -1,228 +1,639 @@
-import psycopg2
+import os
+import itertools
+import collections
 import numpy as np
-from sklearn.preprocessing import OneHotEncoder
-
-DBNAME = "oai2"
-
-# -------------------------------------------------------------------
-# By default psycopg2 converts postgresql decimal/numeric types to 
-# Python Decimal objects. This code forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-# -------------------------------------------------------------------
-
-def get_table_names(dbname=DBNAME):
-    
-    con = psycopg2.connect(database=DBNAME, user='') 
-    cur = con.cursor()
-    sql = "SELECT DISTINCT(table_name) FROM information_schema.columns"
-    sql += " WHERE table_schema='public';"
-    cur.execute(sql)
-    results = cur.fetchall()
-    cur.close()
+from multiprocessing.pool import ThreadPool
+
+from .backends import get_backend
+from .pool import get_pool
+from .timeseries import TimeSeriesStore
+from .metacache import load_metadata_cache
+from .copyfetch import copy_columns
+
+# PostgreSQL database name or connection string, or an embedded database 
+# file (*.duckdb, *.sqlite); can be set with the OAI_DBNAME environment variable
+DBNAME = os.environ.get("OAI_DBNAME", "oai2")
+
+# time series stores directory (createdb.py --tsdir)
+TSDIR = "/tmp/oai-timeseries/"
+
+# columns start:stop of a FeatureBuilder tensor holding variable var_id;
+# labels are the codes of the one-hot columns of nominal variables (None 
+# for missing values)
+FeatureSlice = collections.namedtuple("FeatureSlice", 
+                                      ["var_id","type","start","stop","labels"])
+
+# rows per batch of streamed queries (iter_query)
+ITERSIZE = 10000
+
+# variable catalogs by (dbname, backend), see get_catalog()
+CATALOGS = {}
+
+def query(sql, dbname=DBNAME, backend=None):
+    '''Run query on a pooled connection and return all rows
+    '''
+    with get_pool(dbname, backend).connection() as con:
+        cur = con.cursor()
+        cur.execute(sql)
+        results = cur.fetchall()
+        cur.close()
     
     return results
 
+def iter_query(sql, dbname=DBNAME, backend=None, itersize=ITERSIZE):
+    '''Run query and yield its rows in batches of (at most) itersize rows.
+    PostgreSQL results are streamed from a server-side cursor, so only one
+    batch is held in memory. The pooled connection is returned once the
+    generator is exhausted or closed.
+    '''
+    with get_pool(dbname, backend).connection() as con:
+        cur = get_backend(dbname, backend).stream_cursor(con, itersize)
+        try:
+            cur.execute(sql)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+def iter_columns(sql, dbname=DBNAME, backend=None, itersize=ITERSIZE):
+    '''Like iter_query, but yields every batch as a list of column tuples
+    '''
+    for rows in iter_query(sql, dbname, backend, itersize):
+        yield zip(*rows)
 
-def get_category_vars(ftr_cats):
+def parse_labelset(labelset):
+    '''Split a vardefs labelset into its labels (integer codes where
+    possible)
     '''
+    if labelset == None:
+        return None
+    return [int(x) if x.isdigit() else x for x in labelset.split("|")]
+
+def load_generation(cur, dbname=DBNAME, backend=None):
+    '''Number of times the database has been loaded (0 for databases built
+    before load generations were recorded)
     '''
-    con = psycopg2.connect(database=DBNAME, user='') 
-    cur = con.cursor()
+    cur.execute(get_backend(dbname, backend).table_names_query())
+    if "loadgeneration" not in [x[0] for x in cur.fetchall()]:
+        return 0
+    
+    cur.execute("SELECT generation FROM loadgeneration;")
+    return cur.fetchall()[0][0]
+
+
+class VariableCatalog(object):
+    '''All variable metadata (type, label set, data set, categories, source
+    tables and column descriptions) loaded at once and indexed by var_id, 
+    category, subcategory and table. Variable definitions and categories are
+    read from a metadata cache file (metadata.py --cache) if given.
+    
+    refresh() reloads the catalog only if the database has been reloaded
+    since, according to its load generation.
+    '''
+    def __init__(self, dbname=DBNAME, backend=None, cache=None):
+        self.dbname = dbname
+        self.backend = backend
+        self.cache = cache
+        self.generation = None
+        self.refresh()
     
-    query = """SELECT DISTINCT var_id FROM varcategories
-            WHERE varcategories.cat_id 
-            IN (SELECT id FROM categorydefs WHERE name in (%s));"""
+    def refresh(self):
+        '''Reload the catalog if the database changed. Returns True if it 
+        was reloaded.
+        '''
+        with get_pool(self.dbname, self.backend).connection() as con:
+            cur = con.cursor()
+            try:
+                generation = load_generation(cur, self.dbname, self.backend)
+                if generation == self.generation:
+                    return False
+                
+                self.load(cur)
+                self.generation = generation
+            finally:
+                cur.close()
+        
+        return True
+    
+    def query_vardefs(self, cur):
+        '''Variable definitions in the format of load_metadata_cache()
+        '''
+        cur.execute("SELECT var_id,type,labeln,labelset,dataset,collect_form,comment FROM vardefs;")
+        vardefs = {}
+        for var,t,labeln,labelset,dataset,collect_form,comment in cur.fetchall():
+            vardefs[var] = {"type":t, "labeln":labeln, "labelset":labelset, 
+                            "dataset":dataset, "collect_form":collect_form, 
+                            "comment":comment, "category":[], "subcategory":[]}
+        
+        query = """SELECT varcategories.var_id,categorydefs.type,categorydefs.name 
+                FROM varcategories INNER JOIN categorydefs 
+                ON varcategories.cat_id = categorydefs.id;"""
+        cur.execute(query)
+        for var,t,name in sorted(cur.fetchall()):
+            if var in vardefs:
+                vardefs[var]["category" if t == 1 else "subcategory"].append(name)
+        
+        return vardefs
+    
+    def load(self, cur):
+        
+        backend = get_backend(self.dbname, self.backend)
+        
+        if self.cache:
+            vardefs = load_metadata_cache(self.cache)
+        else:
+            vardefs = self.query_vardefs(cur)
+        
+        cur.execute(backend.columns_query())
+        columns = sorted([(t.lower(),c) for t,c in cur.fetchall()])
+        
+        cur.execute(backend.descriptions_query())
+        self.descriptions = {(t.lower(),c):d for t,c,d in cur.fetchall()}
+        
+        # var_id indexes
+        self.vardefs = vardefs
+        for var in vardefs:
+            vardefs[var]["labels"] = parse_labelset(vardefs[var]["labelset"])
+            vardefs[var]["tables"] = []
+        
+        self.by_table = {}
+        for table,var in columns:
+            self.by_table.setdefault(table,[]).append(var)
+            if var in vardefs:
+                vardefs[var]["tables"].append(table)
+        
+        self.by_category, self.by_subcategory = {}, {}
+        for var in sorted(vardefs):
+            for name in vardefs[var]["category"]:
+                self.by_category.setdefault(name,[]).append(var)
+            for name in vardefs[var]["subcategory"]:
+                self.by_subcategory.setdefault(name,[]).append(var)
+        
+        # array indexes (sorted by var_id)
+        self.var_ids = np.array(sorted(vardefs))
+        self.types = np.array([vardefs[var]["type"] for var in self.var_ids])
+        self.labeln = np.array([vardefs[var]["labeln"] or 0 for var in self.var_ids], 
+                               dtype=np.int32)
+        self.positions = {var:i for i,var in enumerate(self.var_ids)}
     
-    query = query % ",".join(map(lambda x:"'%s'" % x,ftr_cats))
-    cur.execute(query)          
-    results = [x[0] for x in cur.fetchall()]
+    def __contains__(self, var_id):
+        return var_id in self.vardefs
     
-    # get variable types (nominal or continuous)
-    query = "SELECT var_id,type,labeln,dataset FROM vardefs WHERE var_id in (%s);"
-    query = query % ",".join(map(lambda x:"'%s'" % x,results))
-    cur.execute(query)  
-    results = cur.fetchall()
+    def __getitem__(self, var_id):
+        return self.vardefs[var_id]
+    
+    def index(self, var_ids):
+        '''Positions of var_ids in the catalog arrays
+        '''
+        return np.array([self.positions[var] for var in var_ids], dtype=np.int64)
+    
+    def category_vars(self, names):
+        '''Variables with any of the given category or subcategory names
+        '''
+        var_ids = {}
+        for name in names:
+            var_ids.update({var:1 for var in self.by_category.get(name,[])})
+            var_ids.update({var:1 for var in self.by_subcategory.get(name,[])})
+        return sorted(var_ids)
+    
+    def table_vars(self, table_name):
+        return self.by_table.get(table_name.lower(),[])
+    
+    def description(self, table_name, var_id):
+        '''Column description of var_id in table table_name
+        '''
+        key = (table_name.lower(),var_id)
+        if var_id not in self.by_table.get(key[0],[]):
+            raise KeyError("no column %s in table %s" % (var_id,table_name))
+        return self.descriptions.get(key)
+
+
+def get_catalog(dbname=DBNAME, backend=None):
+    '''Shared variable catalog of a database. Call its refresh() to pick up
+    a reloaded database.
+    '''
+    key = (dbname, backend)
+    if key not in CATALOGS:
+        CATALOGS[key] = VariableCatalog(dbname, backend)
+    return CATALOGS[key]
+
+def get_table_names(dbname=DBNAME, backend=None):
+    
+    return query(get_backend(dbname, backend).table_names_query(), dbname, backend)
+
+
+def get_category_vars(ftr_cats, dbname=DBNAME, backend=None, cache=None):
+    '''Nominal and continuous variables in categories ftr_cats. If a 
+    metadata cache file is given, the database isn't queried.
+    '''
+    if cache:
+        vardefs = load_metadata_cache(cache)
+        dtype = {"nominal":{}, "continuous":{}}
+        for var,vardef in vardefs.items():
+            if set(ftr_cats).intersection(vardef["category"] + vardef["subcategory"]) \
+            and vardef["type"] in dtype:
+                dtype[vardef["type"]][var] = (vardef["labeln"],vardef["dataset"])
+        return dtype
+    
+    catalog = get_catalog(dbname, backend)
     
     # sort by data type
-    dtype = {}
-    dtype["nominal"] = {var:(labeln,dataset) for var,t,labeln,dataset 
-                        in results if t == "nominal"}
-    dtype["continuous"] = {var:(labeln,dataset) for var,t,labeln,dataset 
-                           in results if t == "continuous"}
+    dtype = {"nominal":{}, "continuous":{}}
+    for var in catalog.category_vars(ftr_cats):
+        vardef = catalog[var]
+        if vardef["type"] in dtype:
+            dtype[vardef["type"]][var] = (vardef["labeln"],vardef["dataset"])
     
     return dtype
     
 
-def get_var_description(table_name,var_id):
-    '''Ugly SQL for fetching table var comments. Found on
-    http://www.postgresonline.com/journal/archives/215-Querying-table,-view,-column-and-function-descriptions.html
-
+def get_var_description(table_name, var_id, dbname=DBNAME, backend=None):
+    '''Fetch table var comment
     '''
-    query = """SELECT a.attname As column_name,  d.description
-   FROM pg_class As c
-    INNER JOIN pg_attribute As a ON c.oid = a.attrelid
-   LEFT JOIN pg_namespace n ON n.oid = c.relnamespace
-   LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
-   LEFT JOIN pg_description As d ON (d.objoid = c.oid AND d.objsubid = a.attnum)
-   WHERE a.attname='%s' AND n.nspname = 'public' AND c.relname = '%s'
-   ORDER BY n.nspname, c.relname, a.attname;
-    """
-    con = psycopg2.connect(database=DBNAME, user='') 
-    cur = con.cursor()
-    query = query % (var_id,table_name)
-    cur.execute(query)
-    results = cur.fetchall()
-    cur.close()
-    
-    return "[%s] %s" % results[0]
-
-def print_oai_categories():
+    description = get_catalog(dbname, backend).description(table_name, var_id)
+    return "[%s] %s" % (var_id, description)
+
+def print_oai_categories(dbname=DBNAME, backend=None):
     '''Every variable is assigned 1 or more category and subcategory labels
     '''
-    con = psycopg2.connect(database=DBNAME, user='') 
-    cur = con.cursor()
-    cur.execute("SELECT type,name FROM categorydefs;")
-    results = sorted(cur.fetchall())
+    catalog = get_catalog(dbname, backend)
     
     # print categories
     print("CATEGORIES\n------------------------")
-    for name in [x for x in results if x[0]==1]:
-        print("  %s" % name[1])
+    for name in sorted(catalog.by_category):
+        print("  %s" % name)
     
     # print subcategortes
     print("\nSUBCATEGORIES\n------------------------")
-    for name in [x for x in results if x[0]==2]:
-        print("  %s" % name[1])
-            
-    cur.close()
+    for name in sorted(catalog.by_subcategory):
+        print("  %s" % name)
+
+
+def get_accel_data(subjects=None, columns=None, tsdir=TSDIR):
+    '''Iterate over (subject id, {column:array}) pairs of minute-level
+    accelerometer data. Only the data of the requested subjects (default 
+    all) is read.
+    '''
+    store = TimeSeriesStore("%s/acceldata" % tsdir.rstrip("/"))
+    return store.iter_subjects(subjects, columns)
+
+
+def get_observations(var_ids, dbname=DBNAME, backend=None):
+    '''Fetch variables from the long-format observations table (createdb.py 
+    --observations) with a single (var_id, subject, vid) index range scan. 
+    Returns dictionary of var_id -> (datasets, subjects, vids, row_nums, 
+    value_num, value_code) arrays, sorted by subject and visit. dataset and 
+    row_num (the row in the source file) tell apart the values of data sets
+    with several rows per subject and visit.
+    '''
+    sql = """SELECT var_id,dataset,subject,vid,row_num,value_num,value_code 
+            FROM observations WHERE var_id IN (%s) 
+            ORDER BY var_id,subject,vid,dataset,row_num;"""
+    sql = sql % ",".join(map(lambda x:"'%s'" % x.lower(),var_ids))
+    results = query(sql, dbname, backend)
+    
+    # rows are grouped by var_id
+    data = {}
+    for var_id,values in itertools.groupby(results, key=lambda x:x[0]):
+        _,datasets,subjects,vids,row_nums,nums,codes = zip(*values)
+        nums = [np.nan if x == None else x for x in nums]
+        data[var_id] = (np.array(datasets), np.array(subjects), 
+                        np.array(vids,dtype=np.int32), np.array(row_nums,dtype=np.int32),
+                        np.array(nums,dtype=np.float64), np.array(codes,dtype=object))
+    
+    return data
 
 
 class FeatureBuilder(object):
     ''' Return a tensor of features, given a table and set of var_ids
     4796 x 10 x (number of features) 
-    Nominal features are automatically converted to one-hot representations
-    
-    TODO: This could be done much more effeciently
+    Nominal features are automatically converted to one-hot representations.
+    Subjects (rows) are the subjects of jointsx, sorted by id.
     '''
-    def __init__(self,dbname=DBNAME):
+    def __init__(self,dbname=DBNAME,backend=None,cache=None,binary=None,
+                 itersize=None):
         self.dbname = dbname
-        self.con = psycopg2.connect(database=dbname, user='') 
-        self.cur = self.con.cursor()
-        self.table_names = get_table_names(dbname)
+        self.backend = backend
+        
+        # if set, data is streamed in batches of itersize rows and tensors
+        # are assembled batch by batch
+        self.itersize = itersize
+        self.catalog = VariableCatalog(dbname, backend, cache) if cache \
+            else get_catalog(dbname, backend)
+        
+        # PostgreSQL data is fetched with binary COPY unless disabled
+        self.binary = binary
+        if binary == None:
+            self.binary = get_backend(dbname, backend).name == "postgres"
+        self.table_names = get_table_names(dbname, backend)
+        self.visits = self.table_visits()
         
         # create row_id -> subject_id mapping
-        self.cur.execute("SELECT DISTINCT(id) FROM jointsx;")
-        results = sorted([int(x[0]) for x in self.cur.fetchall()])
+        results = self.query("SELECT DISTINCT(id) FROM jointsx;")
+        results = sorted([int(x[0]) for x in results])
         self.row_names = map(str,results)
+        self.subject_ids = np.array(results,dtype=np.int64)
     
-    def get_feature(self,table,var_id,force_continuous=False):
+    def query(self, sql):
+        return query(sql, self.dbname, self.backend)
+    
+    def table_visits(self):
+        '''Dictionary of table -> {vid:visit} (vids number the source files
+        of a table, see createdb.py), or None for databases loaded before 
+        visits were recorded
+        '''
+        if "tablevisits" not in [x[0] for x in self.table_names]:
+            return None
         
-        # get variable type (nominal or continuous)
-        query = "SELECT var_id,type,labeln,labelset FROM vardefs WHERE var_id in (%s);"
-        query = query % ",".join(map(lambda x:"'%s'" % x,[var_id]))
-        self.cur.execute(query)
-        results = self.cur.fetchall()
+        visits = {}
+        for table,vid,visit in self.query("SELECT table_name,vid,visit FROM tablevisits;"):
+            visits.setdefault(table,{})[int(vid)] = int(visit)
+        return visits
+    
+    def columns(self, results, n):
+        '''Split (id, vid, value_1, ..., value_n) rows into subject id and 
+        visit arrays and n value columns
+        '''
+        cols = zip(*results) if results else [()] * (n + 2)
+        sids = np.array(cols[0]).astype(np.int64)
+        vids = np.array(cols[1]).astype(np.int64)
+        return sids, vids, list(cols[2:])
+    
+    def fetch(self, table, var_ids):
+        '''Fetch var_ids from table in one scan. Returns subject id and visit
+        arrays and a float64 array (NaN for NULL) per variable.
+        '''
+        vars = ["id",'vid'] + list(var_ids)
         
-        assert len(results) > 0  
-
-        # query data
-        _,var_type,label_n,labelset = results[0]
-        vars = ["id",'vid'] + [var_id]
-        query = "SELECT %s FROM jointsx ORDER BY id,vid;" % ",".join(vars)
-        self.cur.execute(query)  
-        results = self.cur.fetchall()
-        
-        subjects = {}
-        for row in results:
-            sid,row = row[0],row[1:]
-            subjects[sid] = subjects.get(sid,[]) + [row]
-        
-        #
-        # CASE 1: continuous variable
-        #
-        X = []
-        if var_type == 'continuous' or force_continuous:
-            
-            for sid in self.row_names:
-                m = np.empty((10,1),dtype=np.float64)
-                m.fill(np.nan)
-            
-                for row in subjects[sid]:
-                    vid,tmp = row[0],row[1:]
-                    m[vid] = tmp
-            
-                X += [m]
-            
-            X = np.array(X)
-            
-        #
-        # CASE 1: nominal variable
-        #
-        else:
-            # category variable domain
-            domain = [int(x) for x in labelset.split("|") if x!= "none"]
-            null_id = max(domain) + 1
-            enc = OneHotEncoder(n_values=null_id+1)
-            
-            for sid in self.row_names:
-                m = np.empty((10,1),dtype=np.int8)
-                # fill out empty matrix with the default label for None
-                m.fill(null_id)
-                
-                for row in subjects[sid]:
-                    vid,tmp = row[0],row[1:]
-                    # replace None with null_id value
-                    tmp = [null_id if x==None else int(x) for x in tmp]
-                    m[vid] = tmp
-            
-                X += [m]
-            
-            X = np.array(X)
-            
-            
-            Xt = []
-            for j in range(0,X.shape[1]):
-                x = X[...,j,...]
-                x = enc.fit_transform(x).toarray()
-                Xt += [x]
-               
-            X = np.concatenate(Xt).reshape((4796, 10, -1),order='F').astype(np.int8)
+        if self.binary:
+            kinds = ["int","int"] + ["float"] * len(var_ids)
+            with get_pool(self.dbname, self.backend).connection() as con:
+                cols = copy_columns(con, table, vars, kinds)
+            return cols[0], cols[1], cols[2:]
+        
+        query = "SELECT %s FROM %s;" % (",".join(vars),table)
+        sids, vids, values = self.columns(self.query(query), len(var_ids))
+        return sids, vids, [np.array(col,dtype=np.float64) for col in values]
+    
+    def fetch_chunks(self, table, var_ids):
+        '''Like fetch(), but yields the data in chunks of itersize rows
+        (or all at once if itersize isn't set)
+        '''
+        if not self.itersize:
+            yield self.fetch(table, var_ids)
+            return
+        
+        vars = ["id",'vid'] + list(var_ids)
+        query = "SELECT %s FROM %s;" % (",".join(vars),table)
+        for rows in iter_query(query, self.dbname, self.backend, self.itersize):
+            sids, vids, values = self.columns(rows, len(var_ids))
+            yield sids, vids, [np.array(col,dtype=np.float64) for col in values]
+    
+    def subject_rows(self, sids):
+        '''Dense tensor row (position in row_names) of every subject id, and
+        a mask of the subject ids that are in row_names
+        '''
+        rows = np.searchsorted(self.subject_ids, sids)
+        rows[rows == len(self.subject_ids)] = 0
+        return rows, self.subject_ids[rows] == sids
+    
+    def feature_slices(self, var_ids, force_continuous=False):
+        '''Feature slice of each variable: 1 column for continuous variables,
+        or one column per label (including the null label) for nominal
+        variables
+        '''
+        index, start = [], 0
+        for var_id in var_ids:
+            if var_id not in self.catalog:
+                raise KeyError("unknown variable %s" % var_id)
             
+            vardef = self.catalog[var_id]
+            if vardef["type"] == 'continuous' or force_continuous:
+                index += [FeatureSlice(var_id, "continuous", start, start+1, None)]
+            else:
+                # category variable domain
+                domain = [int(x) for x in vardef["labelset"].split("|") if x!= "none"]
+                null_id = max(domain) + 1
+                labels = range(null_id) + [None]
+                index += [FeatureSlice(var_id, "nominal", start, start+len(labels), labels)]
+            start = index[-1].stop
+        
+        return index
+    
+    def get_features(self,table,var_ids,force_continuous=False):
+        '''Fetch var_ids from table (which must have id and vid columns) in
+        one scan. Returns the (subjects, 10, features) tensor and a list of 
+        FeatureSlice tuples describing the features of each variable. 
+        Invalid codes of nominal variables raise a ValueError (see assemble).
+        '''
+        index = self.feature_slices(var_ids, force_continuous)
+        
+        # one-hot features only are kept as int8
+        dtype = np.int8
+        if [x for x in index if x.type == "continuous"]:
+            dtype = np.float64
+        
+        X = self.empty_tensor(index, dtype)
+        
+        # query data
+        for sids, vids, values in self.fetch_chunks(table, var_ids):
+            self.assemble(X, index, sids, vids, values)
+        
+        return X, index
+    
+    def empty_tensor(self, index, dtype):
+        '''(subjects, 10, features) tensor holding missing values only: NaN,
+        or the default label for None
         '''
-        print X.shape
-        for i in range(0,10):
-            test = X[i,...,...]
-            print self.row_names[i],test.shape
-            print test
+        N = len(self.row_names)
+        X = np.zeros((N,10,index[-1].stop if index else 0),dtype=dtype)
+        
+        for ftr in index:
+            X[:,:,ftr.stop-1] = np.nan if ftr.type == "continuous" else 1
+        
+        return X
+    
+    def assemble(self, X, index, sids, vids, values):
+        '''Write a chunk of fetched data into feature tensor X
         '''
+        # skip subjects that aren't in row_names
+        rows, found = self.subject_rows(sids)
+        rows, vids = rows[found], vids[found]
+        
+        for ftr,col in zip(index,values):
+            col = col[found]
             
+            #
+            # CASE 1: continuous variable
+            #
+            if ftr.type == "continuous":
+                X[rows,vids,ftr.start] = col
+                continue
             
+            #
+            # CASE 2: nominal variable
+            #
+            # replace None with null_id value
+            null_id = len(ftr.labels) - 1
+            missing = np.isnan(col)
+            col[missing] = null_id
             
+            # codes must index one of the variable's labels
+            valid = (col >= 0) & (col < null_id) & (col == np.floor(col))
+            if not (valid | missing).all():
+                raise ValueError("invalid code(s) %s of nominal variable %s" % 
+                                 (np.unique(col[~(valid | missing)])[:5].tolist(), ftr.var_id))
+            
+            # one-hot encode every visit
+            X[rows,vids,ftr.start:ftr.stop] = 0
+            X[rows,vids,ftr.start + col.astype(np.int64)] = 1
+    
+    def get_feature(self,table,var_id,force_continuous=False):
+        '''Feature tensor of a single variable. Codes of a nominal variable
+        that aren't one of its labels raise a ValueError.
+        '''
+        X, index = self.get_features(table, [var_id], force_continuous)
         return X
-        
     
     
+class TableFeatureBuilder(FeatureBuilder):
+    '''Features of all variables of a set of categories found in one table
+    '''
+    # key columns, never features
+    KEY_COLUMNS = ["id","vid","version"]
     
+    def __init__(self,dbname=DBNAME,backend=None,cache=None,binary=None,
+                 itersize=None):
+        super(TableFeatureBuilder, self).__init__(dbname, backend, cache, binary, 
+                                                  itersize)
     
-'''
-class TableFeatureBuilder(FeatureBuilder):
+    def is_feature(self, var_id):
+        '''Only continuous variables and nominal variables with integer
+        codes can be converted to features
+        '''
+        if var_id in self.KEY_COLUMNS or var_id not in self.catalog:
+            return False
+        
+        vardef = self.catalog[var_id]
+        if vardef["type"] == "continuous":
+            return True
+        if vardef["type"] != "nominal" or not vardef["labels"]:
+            return False
+        return not [x for x in vardef["labels"] if type(x) is not int and x != "none"]
+    
+    def is_visit_table(self, table):
+        
+        columns = self.catalog.table_vars(table)
+        return "id" in columns and "vid" in columns
     
-    def __init__(self):
-        super(FeatureBuilder, self).__init__()
+    def category_vars(self, categories):
         
-    def get_features(self,categories):
-        pass
+        return [x for x in self.catalog.category_vars(categories) if self.is_feature(x)]
+    
+    def get_table_features(self,table,categories,force_continuous=False):
+        '''All variables of categories in table, fetched with one query
+        '''
+        columns = {x:1 for x in self.catalog.table_vars(table)}
+        var_ids = [x for x in self.category_vars(categories) if x in columns]
+        return self.get_features(table, var_ids, force_continuous)
     
     
-class CategoryFeatureBuilder(FeatureBuilder):
+class CategoryFeatureBuilder(TableFeatureBuilder):
+    '''Features of all variables of a set of categories, wherever they are
+    stored. One query is planned per table and tables are fetched 
+    concurrently; all tensors share the same (subject, visit) axes. The 
+    visit axis is indexed by visit number (as recorded by createdb.py), 
+    not by vid.
+    '''
+    def __init__(self,dbname=DBNAME,backend=None,cache=None,binary=None,
+                 itersize=None,jobs=4):
+        super(CategoryFeatureBuilder, self).__init__(dbname, backend, cache, binary, 
+                                                     itersize)
+        self.jobs = jobs
     
-    def __init__(self):
-        super(FeatureBuilder, self).__init__()
+    def plan(self, categories):
+        '''Dictionary of table -> var_ids to fetch. Variables stored in 
+        several tables are fetched from the table holding the most requested
+        variables; variables not stored in any subject/visit table are left 
+        out.
+        '''
+        var_ids = self.category_vars(categories)
+        tables = {}
+        for var_id in var_ids:
+            for table in self.catalog[var_id]["tables"]:
+                if self.is_visit_table(table):
+                    tables.setdefault(table,[]).append(var_id)
+        
+        plan, todo = {}, {x:1 for x in var_ids}
+        while todo and tables:
+            table = max(sorted(tables), key=lambda x:len([v for v in tables[x] if v in todo]))
+            cover = [v for v in tables.pop(table) if v in todo]
+            if not cover:
+                break
+            plan[table] = cover
+            for v in cover:
+                del todo[v]
+        
+        return plan
+    
+    def get_category_features(self,categories,force_continuous=False):
+        '''Returns the (subjects, 10, features) tensor of all variables of
+        categories and its list of FeatureSlice tuples (features are grouped
+        by source table)
+        '''
+        plan = self.plan(categories)
+        tables = sorted(plan)
+        
+        fetch = lambda table:self.get_features(table, plan[table], force_continuous)
+        pool = ThreadPool(max(1, min(self.jobs, len(tables))))
+        try:
+            results = pool.map(fetch, tables)
+        finally:
+            pool.terminate()
+        
+        # align the tables' visit axes
+        results = self.align_visits(tables, results)
+        
+        # shift each table's feature slices to its position in the tensor
+        index, start = [], 0
+        for X,ftrs in results:
+            index += [x._replace(start=x.start + start, stop=x.stop + start) for x in ftrs]
+            start += X.shape[2]
+        
+        if not results:
+            return np.zeros((len(self.row_names),10,0),dtype=np.int8), index
+        
+        return np.concatenate([X for X,ftrs in results], axis=2), index
+    
+    def align_visits(self, tables, results):
+        '''Move the features of each table's (X, index) result from vid to
+        visit number. Tables without recorded visits can only be combined 
+        if they have the same vids.
+        '''
+        visits = self.visits or {}
+        unmapped = [x for x in tables if x not in visits]
+        if unmapped:
+            vids = {}
+            for table in tables:
+                sql = "SELECT DISTINCT(vid) FROM %s;" % table
+                vids[table] = tuple(sorted([x[0] for x in self.query(sql)]))
+            if len(tables) > len(unmapped) or len(set(vids.values())) > 1:
+                raise ValueError("visits of %s aren't recorded and can't be aligned with "
+                                 "those of %s; reload them with createdb.py" % 
+                                 (", ".join(unmapped), ", ".join(tables)))
+            return results
+        
+        aligned = []
+        for table,(X,ftrs) in zip(tables,results):
+            if max(visits[table].values()) >= X.shape[1]:
+                raise ValueError("visits of %s exceed the tensor's %d visits" % (table,X.shape[1]))
+            
+            vids = sorted(visits[table])
+            Y = self.empty_tensor(ftrs, X.dtype)
+            Y[:,[visits[table][x] for x in vids]] = X[:,vids]
+            aligned += [(Y,ftrs)]
         
-    def get_category_features(self,categories):
-        pass
-'''        
\ No newline at end of file
+        return aligned
@@ -0,0 +1,180 @@
+'''
+Shared database connection pools. Connections are checked out with
+
+  with get_pool(dbname).connection() as con:
+      cur = con.cursor()
+      ...
+
+and returned to the pool (with their transaction rolled back) afterwards.
+At most maxconn connections per database are open at once; idle ones are
+health checked before being handed out again. Pools are per process, so
+connections are never shared with forked worker processes.
+'''
+import os
+import time
+import threading
+import contextlib
+
+from .backends import get_backend
+
+# default pool sizes
+POOL_MIN = 1
+POOL_MAX = 8
+
+# idle connections are checked before reuse after this many seconds
+CHECK_INTERVAL = 30.0
+
+# pools by (dbname, backend), see get_pool()
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    '''Pool of connections to one database. dbname is a PostgreSQL database
+    name or DSN, or an embedded database file.
+    '''
+    def __init__(self, dbname, backend=None, minconn=POOL_MIN, maxconn=POOL_MAX,
+                 check_interval=CHECK_INTERVAL):
+        self.dbname = dbname
+        self.backend = get_backend(dbname, backend)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.check_interval = check_interval
+
+        self.lock = threading.Condition()
+        self.reset()
+        for i in range(minconn):
+            self.idle += [(self.backend.connect(dbname), time.time())]
+            self.size += 1
+
+    def reset(self):
+        '''Forget all connections (without closing them, they may belong
+        to a parent process)
+        '''
+        self.pid = os.getpid()
+        self.idle = []
+        self.size = 0
+
+    def healthy(self, con, last_used):
+
+        if time.time() - last_used < self.check_interval:
+            return True
+        try:
+            self.backend.ping(con)
+            return True
+        except Exception:
+            return False
+
+    def discard(self, con):
+
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        '''Check out an idle connection, opening a new one if fewer than
+        maxconn are open. Waits up to timeout seconds (default forever)
+        for a connection to be returned.
+        '''
+        deadline = None if timeout == None else time.time() + timeout
+
+        while True:
+            # connecting and health checks happen outside of the lock
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.reset()
+
+                if self.idle:
+                    con, last_used = self.idle.pop()
+                elif self.size < self.maxconn:
+                    con, last_used = None, None
+                    self.size += 1
+                else:
+                    wait = None if deadline == None else deadline - time.time()
+                    if wait != None and wait <= 0:
+                        raise PoolTimeout("no free connection to %s" % self.dbname)
+                    self.lock.wait(wait)
+                    continue
+
+            if con == None:
+                try:
+                    return self.backend.connect(self.dbname)
+                except Exception:
+                    self.release_slot()
+                    raise
+
+            if self.healthy(con, last_used):
+                return con
+            self.discard(con)
+            self.release_slot()
+
+    def release_slot(self):
+
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+
+    def putconn(self, con, broken=False):
+        '''Return a connection. Open transactions are rolled back; broken
+        connections and connections above minconn are closed.
+        '''
+        if not broken:
+            try:
+                self.backend.release(con)
+            except Exception:
+                broken = True
+
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            if broken or len(self.idle) >= self.minconn:
+                self.discard(con)
+                self.size -= 1
+            else:
+                self.idle += [(con, time.time())]
+            self.lock.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        '''Check out a connection for the duration of a with block (the
+        connection is also returned if a generator holding it is closed)
+        '''
+        con, broken = self.getconn(timeout), False
+        try:
+            yield con
+        except Exception:
+            broken = not self.backend.alive(con)
+            raise
+        finally:
+            self.putconn(con, broken)
+
+    def closeall(self):
+
+        with self.lock:
+            for con,last_used in self.idle:
+                self.discard(con)
+            self.size -= len(self.idle)
+            self.idle = []
+
+
+def get_pool(dbname, backend=None, **options):
+    '''Shared pool of database dbname. Options (minconn, maxconn,
+    check_interval) only apply when the pool is created.
+    '''
+    key = (dbname, backend)
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(dbname, backend, **options)
+        return POOLS[key]
+
+def close_pools():
+
+    with POOLS_LOCK:
+        for pool in POOLS.values():
+            pool.closeall()
+        POOLS.clear()
@@ -0,0 +1,95 @@
+'''
+Tests of datasets.oai, run on small SQLite databases:
+
+  python -m unittest datasets.test_oai
+'''
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+
+from .oai import CategoryFeatureBuilder
+
+SUBJECTS = ["9000001","9000002"]
+
+class CategoryVisitsTest(unittest.TestCase):
+    '''ta was collected at visits 00 and 01, tb at visits 00 and 03: both
+    number their files (vids) 0 and 1
+    '''
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def create_db(self, visits):
+        '''Database with variables va (table ta) and vb (table tb) of
+        category "pain", and the given tablevisits rows (None: no visit map)
+        '''
+        dbname = os.path.join(self.tmpdir, "oai-%d.sqlite" % len(os.listdir(self.tmpdir)))
+        con = sqlite3.connect(dbname)
+        con.executescript("""
+            CREATE TABLE vardefs (var_id TEXT, type TEXT, labeln INTEGER, labelset TEXT,
+                                  dataset TEXT, collect_form TEXT, comment TEXT);
+            CREATE TABLE varcategories (var_id TEXT, cat_id INTEGER);
+            CREATE TABLE categorydefs (id INTEGER, type INTEGER, name TEXT);
+            CREATE TABLE colcomments (table_name TEXT, column_name TEXT, description TEXT);
+            CREATE TABLE jointsx (id TEXT, vid SMALLINT);
+            CREATE TABLE ta (id TEXT, vid SMALLINT, va REAL);
+            CREATE TABLE tb (id TEXT, vid SMALLINT, vb REAL);
+            INSERT INTO vardefs VALUES ('va','continuous',0,NULL,'ta','x',NULL),
+                                       ('vb','continuous',0,NULL,'tb','x',NULL);
+            INSERT INTO categorydefs VALUES (1,1,'pain');
+            INSERT INTO varcategories VALUES ('va',1),('vb',1);
+            """)
+        for sid in SUBJECTS:
+            con.execute("INSERT INTO jointsx VALUES (?,0);", (sid,))
+            for vid in [0,1]:
+                con.execute("INSERT INTO ta VALUES (?,?,?);", (sid,vid,1.0 + vid))
+                con.execute("INSERT INTO tb VALUES (?,?,?);", (sid,vid,10.0 + vid))
+
+        if visits != None:
+            con.execute("CREATE TABLE tablevisits (table_name TEXT, vid SMALLINT, visit SMALLINT);")
+            con.executemany("INSERT INTO tablevisits VALUES (?,?,?);", visits)
+        con.commit()
+        con.close()
+
+        return dbname
+
+    def test_aligned_by_visit(self):
+
+        dbname = self.create_db([("ta",0,0),("ta",1,1),("tb",0,0),("tb",1,3)])
+        X, index = CategoryFeatureBuilder(dbname, "sqlite").get_category_features(["pain"])
+
+        self.assertEqual([x.var_id for x in index], ["va","vb"])
+        np.testing.assert_array_equal(X[:,[0,1],0], [[1.0,2.0]] * len(SUBJECTS))
+        np.testing.assert_array_equal(X[:,[0,3],1], [[10.0,11.0]] * len(SUBJECTS))
+
+        # vb wasn't collected at visit 01, va not at visit 03
+        self.assertTrue(np.isnan(X[:,1,1]).all())
+        self.assertTrue(np.isnan(X[:,3,0]).all())
+
+    def test_no_visit_map(self):
+
+        dbname = self.create_db(None)
+        con = sqlite3.connect(dbname)
+        con.executemany("INSERT INTO tb VALUES (?,2,12.0);", [(x,) for x in SUBJECTS])
+        con.commit()
+        con.close()
+
+        builder = CategoryFeatureBuilder(dbname, "sqlite")
+        self.assertRaises(ValueError, builder.get_category_features, ["pain"])
+
+    def test_partial_visit_map(self):
+
+        dbname = self.create_db([("ta",0,0),("ta",1,1)])
+        builder = CategoryFeatureBuilder(dbname, "sqlite")
+        self.assertRaises(ValueError, builder.get_category_features, ["pain"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+'''
+Reader for the chunked time series stores (e.g., AccelData) written by
+utils/dbimport/createdb.py --tsdir. Only the chunks and columns holding
+the requested subjects are decompressed, so the data set is never loaded
+as a whole.
+'''
+import os
+import json
+import numpy as np
+
+STORE_VERSION = 1
+
+class TimeSeriesStore(object):
+    '''Per-subject access to a time series store directory
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path,"index.json"),"rU") as f:
+            index = json.load(f)
+
+        if index["version"] != STORE_VERSION:
+            raise ValueError("unsupported time series store version %s" % index["version"])
+
+        self.key = index["key"]
+        self.columns = [name for name,kind in index["columns"]]
+        self.kinds = dict(index["columns"])
+        self.chunks = index["chunks"]
+        self.segments = index["subjects"]
+        self.rows = index["rows"]
+        self.subjects = sorted(self.segments.keys())
+
+        # decompressed columns of the most recently read chunk
+        self._chunk, self._cache = None, {}
+
+    def chunk_column(self, chunk, name):
+
+        if chunk != self._chunk:
+            self._chunk, self._cache = chunk, {}
+        if name not in self._cache:
+            with np.load(os.path.join(self.path,self.chunks[chunk])) as data:
+                self._cache[name] = data[name]
+        return self._cache[name]
+
+    def get_subject(self, sid, columns=None):
+        '''Return dictionary of column name -> NumPy array with all rows of
+        subject sid (in their original order)
+        '''
+        columns = columns or [x for x in self.columns if x != self.key]
+        segments = self.segments.get(str(sid),[])
+
+        data = {}
+        for name in columns:
+            parts = [self.chunk_column(chunk,name)[start:stop]
+                     for chunk,start,stop in segments]
+            data[name] = np.concatenate(parts) if parts else np.array([])
+        return data
+
+    def iter_subjects(self, subjects=None, columns=None):
+        '''Iterate over (subject id, column dictionary) pairs. Subjects are
+        visited in storage order, so every chunk is decompressed only once.
+        '''
+        subjects = self.subjects if subjects == None else map(str,subjects)
+        subjects = sorted(subjects, key=lambda x:self.segments.get(x,[[-1]])[0])
+
+        for sid in subjects:
+            yield sid, self.get_subject(sid, columns)
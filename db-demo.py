@@ -10,7 +10,7 @@ PostgreSQL OAI Database Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 
 import numpy as np
 from scipy import stats
@@ -27,14 +27,6 @@ from sklearn.metrics import mean_squared_error,r2_score
 from sklearn.learning_curve import learning_curve
 from statsmodels.base.model import Results
 
-# By default psycopg2 converts postgresql decimal/numeric types to 
-# Python Decimal objects. This function forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-
 def main(args):
     
     #
@@ -43,12 +35,9 @@ def main(args):
     query = """
             SELECT column_name
             FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='outcomes99'
+            WHERE table_schema='public' AND table_name='outcomes'
             """
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
-    cur.execute(query)          
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     
     print results
     sys.exit()
@@ -56,10 +45,11 @@ def main(args):
     # Let's model all 
     # model WOMAC Pain (V00WOMKPL) 
     # x: WOMAC is on a scale of 0..20 where 0 indicates no difficulty
-    query = """SELECT V00WOMKPL,V00KOOSKPL FROM allclinical00 
-    WHERE V00WOMKPL IS NOT NULL AND V00KOOSKPL IS NOT NULL;"""
-    cur.execute(query) 
-    results = cur.fetchall()
+    # (AllClinical is stored split by variable category; both variables
+    # are read from the JointSx data set that defines them)
+    query = """SELECT vwomkpl,vkooskpl FROM jointsx WHERE vid = 0 
+    AND vwomkpl IS NOT NULL AND vkooskpl IS NOT NULL;"""
+    results = oai.query(query, args.dbname)
     
     
     
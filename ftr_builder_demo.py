@@ -71,3 +71,13 @@ ftr_names = get_category_vars(ftr_cats)
 print(ftr_names['continuous'])
 print(ftr_names['nominal'])
 print("\n")
+
+###############################################################################
+
+# Example 3: All features of a set of categories, fetched with one query per
+# source table. The index describes the feature columns of every variable.
+ctgbldr = CategoryFeatureBuilder()
+X, index = ctgbldr.get_category_features(["womac pain","koos pain"])
+print(X.shape)
+for ftr in index:
+    print("%s %s [%s:%s]" % (ftr.var_id, ftr.type, ftr.start, ftr.stop))
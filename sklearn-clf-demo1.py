@@ -13,7 +13,7 @@ Scikit-learn OAI Linear Regression Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 import operator
 import numpy as np
 import math
@@ -55,11 +55,8 @@ def main(args):
     #    by their next OAI visit?
  
     # Identify our subjects (anyone with a R or L TKA)
-    con = psycopg2.connect(database="oai2", user='') 
-    cur = con.cursor()
     query = "SELECT id,verkfldt,velkfldt FROM outcomes;"
-    cur.execute(query)
-    results = cur.fetchall()
+    results = oai.query(query)
 
     # 342/4552 Subjects: 203 Right, 210 Left, 71 R+L
     subjects = {id:[rtka,ltka] for id,rtka,ltka in results 
@@ -69,11 +66,10 @@ def main(args):
     visit_defs = {0:0, 1:12, 2:18 ,3:24, 4:30, 5:36, 6:48, 7:60, 8:72, 9:84}
     
     ids = ["'%s'" % id for id in subjects]
-    query = "SELECT ID,V99ELKVSPR,V99ELKVSAF,V99ERKVSPR,V99ERKVSAF "
-    query += "FROM outcomes99 WHERE ID in (%s);"
+    query = "SELECT id,velkvspr,velkvsaf,verkvspr,verkvsaf "
+    query += "FROM outcomes WHERE id in (%s);"
     query = query % ",".join(ids)
-    cur.execute(query) 
-    results = cur.fetchall()
+    results = oai.query(query)
  
  
     # Load Data Set 
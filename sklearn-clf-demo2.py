@@ -12,7 +12,7 @@ Scikit-learn OAI Linear Regression Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 import operator
 import numpy as np
 import math
@@ -33,16 +33,6 @@ from sklearn.learning_curve import learning_curve
 from sklearn.metrics import make_scorer
 from sklearn.preprocessing import OneHotEncoder
 
-# -------------------------------------------------------------------
-# By default psycopg2 converts postgresql decimal/numeric types to 
-# Python Decimal objects. This code forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-# -------------------------------------------------------------------
-
 def sm_histogram(X,bins=10):
     
     # kernel density estimation
@@ -57,27 +47,18 @@ def sm_histogram(X,bins=10):
 
 def get_table_names():
     
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
     sql = "SELECT DISTINCT(table_name) FROM information_schema.columns"
     sql += " WHERE table_schema='public';"
-    cur.execute(sql)
-    results = cur.fetchall()
     
-    return results
+    return oai.query(sql, args.dbname)
 
 def query_db(sql):
     
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
-    cur.execute(sql)
-    return cur.fetchall()
+    return oai.query(sql, args.dbname)
 
 def main(args):
     
     np.random.seed(123456)
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
     
     # ===============================================
     #
@@ -95,9 +76,8 @@ def main(args):
     # -----------------------------------------------
     
     # Identify our subjects (anyone with a R or L TKA)
-    query = "SELECT ID,v99erkfldt,v99elkfldt FROM outcomes99;"
-    cur.execute(query)          
-    results = cur.fetchall()
+    query = "SELECT id,verkfldt,velkfldt FROM outcomes;"
+    results = oai.query(query, args.dbname)
 
     # 342/4552 Subjects: 203 Right, 210 Left, 71 R+L
     subjects = {id:[rtka,ltka] for id,rtka,ltka in results 
@@ -107,11 +87,10 @@ def main(args):
     visit_defs = {0:0, 1:12, 2:18 ,3:24, 4:30, 5:36, 6:48, 7:60, 8:72, 9:84}
     
     ids = ["'%s'" % id for id in subjects]
-    query = "SELECT ID,V99ELKVSPR,V99ELKVSAF,V99ERKVSPR,V99ERKVSAF "
-    query += "FROM outcomes99 WHERE ID in (%s);"
+    query = "SELECT id,velkvspr,velkvsaf,verkvspr,verkvsaf "
+    query += "FROM outcomes WHERE id in (%s);"
     query = query % ",".join(ids)
-    cur.execute(query) 
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     
     # ID: Left-Before, Left-After, Right-Before, Right-After
     before_after_dates = {x[0]:x[1:] for x in results}
@@ -138,8 +117,7 @@ def main(args):
         WHERE table_schema='public' AND table_name SIMILAR TO '%jointsx%'
         AND column_name=lower(vardefs.var_id);
     """
-    cur.execute(query) 
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     joint_vars = {x[0]:x[1] for x in results}
     
     tbl = "jointsx"
@@ -10,7 +10,7 @@ Scikit-learn OAI Linear Regression Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 import numpy as np
 import math
 import matplotlib.pyplot as plt
@@ -23,20 +23,10 @@ from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans,SpectralClustering
 from preprocessing.imputation import ses, interpolate
 
-# By default psycopg2 converts postgresql decimal/numeric types to 
-# Python Decimal objects. This function forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-
 
 def main(args):
     
     np.random.seed(123456)
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
     
     # Select all features related to WOMAC/KOOS pain subcategories
     ftr_cats = ["womac pain","koos pain"]
@@ -44,14 +34,12 @@ def main(args):
     query = "SELECT var_id FROM varcategories WHERE varcategories.cat_id IN "
     query += "(SELECT id FROM categorydefs WHERE name in (%s) AND type=2);"
     query = query % ",".join(map(lambda x:"'%s'" % x,ftr_cats))
-    cur.execute(query)          
-    results = [x[0] for x in cur.fetchall()]
+    results = [x[0] for x in oai.query(query, args.dbname)]
     
     # get variable types (nominal or continuous)
     query = "SELECT var_id,type,labeln FROM vardefs WHERE var_id in (%s);"
     query = query % ",".join(map(lambda x:"'%s'" % x,results))
-    cur.execute(query)  
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     
     # sort by data type
     dtype = {}
@@ -61,8 +49,7 @@ def main(args):
     # KOOS and WOMAC pain scores measure similar things (essentially)
     vars = ["id",'vid'] + sorted(dtype["continuous"].keys())
     query = "SELECT %s FROM jointsx ORDER BY id,vid;" % ",".join(vars)
-    cur.execute(query)  
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     
     # create subjects
     subjects = {}
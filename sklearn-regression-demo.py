@@ -10,7 +10,7 @@ Scikit-learn OAI Linear Regression Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 
 import numpy as np
 import math
@@ -28,14 +28,6 @@ from sklearn.metrics import mean_squared_error,r2_score
 from sklearn.learning_curve import learning_curve
 from sklearn.metrics import make_scorer
 
-# By default psycopg2 converts postgresql decimal/numeric types to 
-# Python Decimal objects. This function forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-
 def main(args):
     
     #
@@ -44,12 +36,9 @@ def main(args):
     query = """
             SELECT column_name
             FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='allclinical00'
+            WHERE table_schema='public' AND table_name='jointsx'
             """
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
-    cur.execute(query)          
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     
     #
     # scikit-learn
@@ -62,10 +51,11 @@ def main(args):
     #
     # NOTE: we are removing instances where one or both observations are missing
     # In a real modeling problem we have to be more mindful of missing values. 
-    query = """SELECT V00WOMKPL,V00KOOSKPL FROM allclinical00 
-    WHERE V00WOMKPL IS NOT NULL AND V00KOOSKPL IS NOT NULL;"""
-    cur.execute(query) 
-    results = cur.fetchall()
+    # (AllClinical is stored split by variable category; both variables
+    # are read from the JointSx data set that defines them)
+    query = """SELECT vwomkpl,vkooskpl FROM jointsx WHERE vid = 0 
+    AND vwomkpl IS NOT NULL AND vkooskpl IS NOT NULL;"""
+    results = oai.query(query, args.dbname)
     
     # Fix a random seed so that our random number generation is deterministic
     np.random.seed(123456)
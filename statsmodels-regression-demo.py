@@ -12,7 +12,7 @@ OAI Database Demo
 '''
 import sys
 import argparse
-import psycopg2
+from datasets import oai
 
 import numpy as np
 from scipy import stats
@@ -28,14 +28,6 @@ from sklearn.cross_validation import cross_val_score
 from sklearn.metrics import mean_squared_error,r2_score
 from sklearn.learning_curve import learning_curve
 
-# By default psycopg2 converts postgresql decimal/numeric types 
-# to Python Decimal objects. This function forces a float type cast instead
-DEC2FLOAT = psycopg2.extensions.new_type(
-    psycopg2.extensions.DECIMAL.values,
-    'DEC2FLOAT',
-    lambda value, curs: float(value) if value is not None else None)
-psycopg2.extensions.register_type(DEC2FLOAT)
-
 def main(args):
     
     np.random.seed(123456)
@@ -44,14 +36,11 @@ def main(args):
     # Select column names from specific table
     #
     query = """
-            SELECT V99ERKDAYS
-            FROM outcomes99
-            WHERE V99ERKDAYS IS NOT NULL;
+            SELECT verkdays
+            FROM outcomes
+            WHERE verkdays IS NOT NULL;
             """
-    con = psycopg2.connect(database=args.dbname, user='') 
-    cur = con.cursor()
-    cur.execute(query)          
-    results = cur.fetchall()
+    results = oai.query(query, args.dbname)
     results = [x[0] for x in results]
     
     # kernel density estimation
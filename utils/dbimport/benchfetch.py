@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Fetch throughput benchmark: the same synthetic table stored with the old
+column types (every number NUMERIC, fetched through the DEC2FLOAT Python
+typecaster used by datasets/oai.py and the demo scripts) and with the
+types inferred by createdb.py (SMALLINT codes, REAL/DOUBLE PRECISION
+measurements). Tables are created as TEMP tables, so nothing is left in
+the database.
+
+USAGE: benchfetch.py -d oai2 [-n ROWS] [-c COLUMNS] [-r REPEAT]
+'''
+import sys
+import time
+import argparse
+import psycopg2
+
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    'DEC2FLOAT',
+    lambda value, curs: float(value) if value is not None else None)
+
+# column types of each layout: half nominal codes, half measurements
+LAYOUTS = [("numeric", "NUMERIC", "NUMERIC"),
+           ("precise", "SMALLINT", "DOUBLE PRECISION")]
+
+def create_table(cur, name, code_type, num_type, rows, columns):
+    '''Synthetic wide table of (id, vid) and columns alternating between
+    nominal codes (0..4) and measurements
+    '''
+    cols = ["c%d %s" % (j,code_type if j % 2 == 0 else num_type) for j in range(columns)]
+    cur.execute("CREATE TEMP TABLE %s (id TEXT, vid SMALLINT, %s);" % (name,", ".join(cols)))
+
+    values = ["(random() * 4)::int" if j % 2 == 0 else "random() * 100"
+              for j in range(columns)]
+    sql = "INSERT INTO %s SELECT (9000000 + i / 10)::text, i %% 10, %s" % (name,", ".join(values))
+    sql += " FROM generate_series(0,%d) AS i;" % (rows - 1)
+    cur.execute(sql)
+    cur.execute("ANALYZE %s;" % name)
+
+def fetch_time(cur, name, repeat):
+    '''Best of repeat full table fetches, in seconds
+    '''
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        cur.execute("SELECT * FROM %s;" % name)
+        cur.fetchall()
+        times += [time.time() - t0]
+    return min(times)
+
+def main(args):
+
+    con = psycopg2.connect(database=args.dbname, user='')
+    cur = con.cursor()
+
+    # the typecaster only applies to this connection
+    psycopg2.extensions.register_type(DEC2FLOAT, con)
+
+    sys.stdout.write("%-10s %12s %12s %12s\n" % ("layout","size (KB)","seconds","rows/s"))
+    for name,code_type,num_type in LAYOUTS:
+        table = "bench_%s" % name
+        create_table(cur, table, code_type, num_type, args.rows, args.columns)
+
+        cur.execute("SELECT pg_total_relation_size('%s');" % table)
+        size = cur.fetchone()[0] / 1024
+        secs = fetch_time(cur, table, args.repeat)
+        sys.stdout.write("%-10s %12d %12.3f %12d\n" % (name,size,secs,args.rows / secs))
+
+    con.rollback()
+    con.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d","--dbname", type=str, help="database to run the benchmark in")
+    parser.add_argument("-n","--rows", type=int, default=50000, help="number of rows")
+    parser.add_argument("-c","--columns", type=int, default=100, help="number of columns")
+    parser.add_argument("-r","--repeat", type=int, default=3, help="fetches per layout")
+    args = parser.parse_args()
+
+    # argument error, exit
+    if not args.dbname:
+        parser.print_help()
+        sys.exit()
+
+    main(args)
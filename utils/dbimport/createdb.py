@@ -9,38 +9,55 @@ import sas7bdat
 import argparse
 import sys
 import operator
+import itertools
+import multiprocessing
+import shutil
+import tempfile
+import datetime
+import collections
+import time
+import numpy as np
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+from labels import norm_col_label
+from instrument import ImportStats, TimedFile
+from loaders import LOADERS, GENERATION_SQL, VISITS_TABLE, VISITS_SCHEMA, \
+    psql_esc_str, compile_encoders, encode_rows
+from timeseries import TimeSeriesWriter, column_kind
+from observations import ObservationSpool, OBSERVATIONS_TABLE, OBSERVATIONS_TYPES, \
+    OBSERVATIONS_SCHEMA, index_sql, clear_sql
+from manifest import load_manifest, file_checksums, is_current, \
+    invalidate_group, record_group
 
 TMP_ROOT = "/tmp/"
 ROW_INSERT_MAX = 5000
+TYPE_INFER_ROWS = 1000
+BATCH_ROWS = 1000
+
+# skip these data sets as they require special handing
+SKIP_GROUPS = []
+
+# minute-level data sets written to chunked time series stores (--tsdir)
+# instead of the database
+TIMESERIES_GROUPS = ["AccelData"]
+
+# data sets with too many columns for a single table; these are split 
+# vertically into one table per variable category
+PARTITION_GROUPS = ["AllClinical"]
+PARTITION_KEYS = ["id","vid","version"]
 
-def psql_esc_str(s):
-    return s.replace("'","''").replace("\\","\\\\")
+# import pipeline timing (per process)
+STATS = ImportStats()
 
 def norm_col_name(s):
     '''Normalize sql column name
     '''
     return re.sub("^([V]+)(\d\d)",r'\1',s).lower()
 
-def longest_common_substring(s1, s2):
-    m = [[0] * (1 + len(s2)) for i in xrange(1 + len(s1))]
-    longest, x_longest = 0, 0
-    for x in xrange(1, 1 + len(s1)):
-        for y in xrange(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
-                    x_longest = x
-            else:
-                m[x][y] = 0
-    return s1[x_longest - longest: x_longest]
-
-def norm_col_label(labels):
-    
-    labels = [x for x in labels if x] # remove null strs
-    labels = reduce(longest_common_substring,labels)
-    return labels.strip(":").strip(".").strip()
-
 def group_by_filename(filelist):
     tmp = {}
     for filename in filelist:
@@ -50,7 +67,173 @@ def group_by_filename(filelist):
         tmp[prefix] = sorted(tmp[prefix])
     return tmp
 
-def create_table_schema(name, vardefs, varlabels, pkeys):
+# length is the SAS storage width in bytes (None if unknown)
+SASColumn = collections.namedtuple("SASColumn",["name","format","label","type","length"])
+
+# smallest integer type holding a range of codes
+INTEGER_TYPES = [("SMALLINT",2**15), ("INTEGER",2**31)]
+
+def row_batches(rows, n):
+    '''Group a row iterator into column batches of at most n rows
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, n))
+        if not batch:
+            return
+        yield [np.array(col, dtype=object) for col in zip(*batch)]
+
+def column_values(col):
+    '''Convert a column batch to a list of Python values (None if missing)
+    '''
+    if col.dtype.kind == "f":
+        values = col.astype(object)
+        values[np.isnan(col)] = None
+        return values.tolist()
+    
+    # NaT is converted to None
+    if col.dtype.kind == "M":
+        return col.astype("M8[D]").tolist()
+    
+    return col.tolist()
+
+def column_types(col):
+    '''Count the Python types of non-missing values in a column batch
+    '''
+    if col.dtype.kind == "f":
+        return {float:int(np.count_nonzero(col == col))}
+    
+    if col.dtype.kind == "M":
+        return {datetime.date:len(col)}
+    
+    counts = {}
+    for v in col:
+        if v != None:
+            counts[type(v)] = counts.get(type(v),0) + 1
+    return counts
+
+def integer_type(values):
+    '''Smallest SQL integer type holding all values
+    '''
+    for sql_type,bound in INTEGER_TYPES:
+        if -bound <= min(values) and max(values) < bound:
+            return sql_type
+    return None
+
+def seekable_member(zf, member):
+    '''Open zip member as a seekable file. Zip members are only seekable in
+    Python 3.7+, otherwise the member is spooled to an anonymous temp file.
+    '''
+    fh = TimedFile(zf.open(member), STATS)
+    if fh.seekable():
+        return fh
+    
+    tmp = tempfile.TemporaryFile(dir=TMP_ROOT)
+    shutil.copyfileobj(fh, tmp)
+    fh.close()
+    tmp.seek(0)
+    return tmp
+
+
+class SASReader(object):
+    '''Stream a SAS7BDAT member out of its zip archive as column batches 
+    (one NumPy array per column). A bounded prefix of batches is buffered 
+    for type inference; batches() yields the buffered prefix and then the 
+    remaining batches, so each member is only decoded once.
+    
+    Subclasses implement open(), which sets columns (list of SASColumn) 
+    and stream (iterator of column batches), and close().
+    '''
+    def __init__(self, zf, member, prefix_max=TYPE_INFER_ROWS, batch_rows=BATCH_ROWS):
+        self.zf = zf
+        self.member = member
+        self.batch_rows = batch_rows
+        self.decode(self.open)
+        
+        self.prefix, n = [], 0
+        while n < prefix_max:
+            batch = self.decode(next, self.stream, None)
+            if batch is None:
+                break
+            self.prefix += [batch]
+            n += len(batch[0]) if batch else prefix_max
+    
+    def decode(self, func, *args):
+        '''Call func, recording decode time apart from time spent reading
+        (decompressing) the member
+        '''
+        t0, unzip = time.time(), STATS.seconds("unzip")
+        result = func(*args)
+        STATS.add("decode", time.time() - t0 - (STATS.seconds("unzip") - unzip))
+        return result
+    
+    def batches(self):
+        prefix, self.prefix = self.prefix, []
+        for batch in prefix:
+            yield batch
+        
+        batch = self.decode(next, self.stream, None)
+        while batch is not None:
+            yield batch
+            batch = self.decode(next, self.stream, None)
+        self.close()
+
+
+class Sas7bdatReader(SASReader):
+    '''Pure Python, row at a time decoder (sas7bdat package). Members are 
+    streamed directly from the archive (no temp files or in-memory copy).
+    '''
+    def open(self):
+        fh = TimedFile(self.zf.open(self.member), STATS)
+        self.data = sas7bdat.SAS7BDAT(self.member, fh=fh, skip_header=True)
+        self.columns = [SASColumn(col.name,col.format,col.label,col.type,col.length) 
+                        for col in self.data.columns]
+        self.stream = row_batches(self.data, self.batch_rows)
+    
+    def close(self):
+        self.data.close()
+        self.zf.close()
+
+
+class PandasReader(SASReader):
+    '''Chunked, columnar decoder (pandas.read_sas). Numeric columns are 
+    float64 (NaN if missing), dates datetime64 and strings object arrays 
+    (None if missing).
+    '''
+    def open(self):
+        if pandas is None:
+            sys.stderr.write("FATAL ERROR -- pandas reader requires pandas\n")
+            sys.exit()
+        
+        self.fh = seekable_member(self.zf, self.member)
+        self.data = pandas.read_sas(self.fh, format="sas7bdat", 
+                                    chunksize=self.batch_rows, encoding="utf-8")
+        self.columns = [SASColumn(col.name,col.format,col.label,
+                                  "string" if col.ctype == b"s" else "number",
+                                  col.length) 
+                        for col in self.data.columns]
+        self.stream = (self.chunk_batch(df) for df in self.data)
+    
+    def chunk_batch(self, df):
+        batch = []
+        for name in df.columns:
+            values = df[name].values
+            if values.dtype.kind == "O":
+                values = values.copy()
+                values[pandas.isnull(values)] = None
+            batch += [values]
+        return batch
+    
+    def close(self):
+        self.data.close()
+        self.fh.close()
+        self.zf.close()
+
+
+# SAS reader backends
+READERS = {"sas7bdat":Sas7bdatReader, "pandas":PandasReader}
+
+def create_table_schema(name, vardefs, varlabels, pkeys, comments=True):
     
     sql = "CREATE TABLE %s (\n" % name
     columns = []
@@ -75,6 +258,9 @@ def create_table_schema(name, vardefs, varlabels, pkeys):
         
     sql = sql + "%s);" % ",\n".join(columns)
     
+    if not comments:
+        return sql + "\n"
+    
     comments = []
     for var in varlabels:
         label = psql_esc_str(varlabels[var]).decode("utf-8",errors='ignore')
@@ -85,111 +271,120 @@ def create_table_schema(name, vardefs, varlabels, pkeys):
     
     return sql
 
-def sql_insert(name, data, sql_types, vid=None, row_max=ROW_INSERT_MAX):
-  
-    # use SAS header information to get table name and data types
-    tbl_name = data.header.properties.name[:-2]
-  
-    header = None
-    dtypes = None
-    rows = []
-    for i,row in enumerate(data):
-        
-        if i == 0:
-            # normalize variable names
-            header = [norm_col_name(x) if x not in ["id","version"] else x for x in row ]
-            dtypes = [sql_types[x] for x in header]
-            if vid != None: 
-                header = ["vid"] + header
-                dtypes = ["NUMERIC"] + dtypes
-            continue
-        
+def sas_batches(data, vid=None):
+    '''Iterate over SAS data, yielding the normalized column header first and 
+    then each batch of column values. If vid is provided it's prepended as
+    a constant column.
+    '''
+    header = [col.name for col in data.columns]
+    header = [norm_col_name(x) if x not in ["id","version"] else x for x in header]
+    if vid != None: 
+        header = ["vid"] + header
+    yield header
+    
+    for batch in data.batches():
+        with STATS.timed("encode"):
+            cols = map(column_values,batch)
         if vid != None: 
-            row = [vid] + row
-            
-        # escape strings (' and \ characters) and add NULL values to row
-        row = [v if v != None and v != "" else "NULL" for v in row]
-        
-        row = [psql_esc_str(v) if type(v) in [str,unicode] else v 
-               for v in row]
-        
-        # set data type
-        row = ["%s" % v if type(v) in [float,int] or v == "NULL" else "'%s'" % v 
-               for v in row]
-            
-        rows += [",".join(row)]
-        
-    print "INSERT INTO %s (%s) VALUES\n" % (name,",".join(header))
-    rows = map(lambda x:"\t(%s)" % x, rows)
-    rows = ",\n".join(rows)
-    print "%s;\n\n" % rows
-   
-def enrollees_sql_insert(name, data, sql_types):
+            cols = [[vid] * len(cols[0])] + cols
+        yield cols
+
+def enrollees_plan(header):
     '''Enrollees data is collapsed into 1 data set (rather than split by visit).
-    This creates up to 8 rows per subjects, uniqiuely identified by ID,VID
+    This creates up to 8 rows per subjects, uniqiuely identified by ID,VID. 
+    
+    The wide-to-long pivot plan is built once from the SAS header: for each 
+    visit, the source column index (None if missing) of every insert_header
+    column. 
     '''
-    header,normheader,insert_header = None,None,None
-
-    rows = []
+    # normalize variable names
+    normheader = [norm_col_name(x) if x not in ["id","version"] else x for x in header]
+    tmp = sorted({x:1 for x in normheader if x not in ["id","version"]}.keys())
+    insert_header = ["id","vid","version"] + tmp
     
-    for i,row in enumerate(data):
-        
-        if i == 0:
-            # normalize variable names
-            header = row
-            normheader = [norm_col_name(x) if x not in ["id","version"] else x for x in row]
-            tmp = sorted({x:1 for x in normheader if x not in ["id","version"]}.keys())
-            insert_header = ["id","vid","version"] + tmp
-            
-            continue
-  
-        fields = dict(zip(map(lambda x:x.lower(),header),row))
-        vids = map(lambda x:int(x) if x.isdigit() else 0,[x[1:3] for x in header if x[0]!="v"])
-        vids = {v:1 for v in vids}
-        
-        for vid in vids:
-            subrow = []
-            vidprefix = "V" + ("0" + str(vid))[-2:]
-        
-            
-            for var in insert_header:
-              
-                unvar = (vidprefix + var[1:]).lower()
-                
-                if var in fields:
-                  
-                    subrow += [fields[var]]
-                elif unvar in fields:
-            
-                    subrow += [fields[unvar]]
-                else:
-                    subrow += [None]
-            
-            subrow[1] = vid
-            rows += [subrow]
-        
-        
-    # normalize sql statements
-    for i,row in enumerate(rows):
+    index = dict(zip(map(lambda x:x.lower(),header),range(len(header))))
+    vids = map(lambda x:int(x) if x.isdigit() else 0,[x[1:3] for x in header if x[0]!="v"])
+    vids = sorted({v:1 for v in vids}.keys())
+    
+    plan = []
+    for vid in vids:
+        vidprefix = "V" + ("0" + str(vid))[-2:]
         
-        # escape strings (' and \ characters) and add NULL values to row
-        row = [v if v != None and v != "" else "NULL" for v in row]
+        # visit independent columns first, then the column for this visit
+        src = []
+        for var in insert_header:
+            unvar = (vidprefix + var[1:]).lower()
+            src += [index[var] if var in index else index.get(unvar)]
         
-        row = [psql_esc_str(v) if type(v) in [str,unicode] else v 
-               for v in row]
+        plan += [(vid,src)]
+    
+    return insert_header, plan
+
+def enrollees_batches(data):
+    '''Apply the Enrollees pivot plan to whole column batches, yielding the
+    insert header first and then one batch per (input batch, visit)
+    '''
+    header = [col.name for col in data.columns]
+    insert_header, plan = enrollees_plan(header)
+    yield insert_header
+    
+    for batch in data.batches():
+        with STATS.timed("encode"):
+            cols = map(column_values,batch)
+        n = len(cols[0]) if cols else 0
+        null = [None] * n
         
-        # set data type
-        row = ["%s" % v if type(v) in [float,int] or v == "NULL" else "'%s'" % v 
-               for v in row]
+        for vid,src in plan:
+            subcols = [cols[j] if j != None else null for j in src]
+            subcols[1] = [vid] * n
+            yield subcols
+
+def sql_emit(name, batches, sql_types, row_max=ROW_INSERT_MAX, db=None, out=None):
+    '''Output column batches as INSERT statements of at most row_max rows 
+    (to out, default stdout) or, if a database loader is provided, load them 
+    directly. Statements are written as soon as they're ready, so memory use
+    doesn't depend on table size. Returns the number of rows.
+    '''
+    header = next(batches)
+    
+    if db:
+        return db.load(name, header, batches, sql_types)
+    
+    out = out or sys.stdout
+    rows = encode_rows(batches, compile_encoders(header, sql_types), STATS)
+    stmt = "INSERT INTO %s (%s) VALUES\n" % (name,",".join(header))
+    
+    n = 0
+    while True:
+        chunk = list(itertools.islice(rows, row_max))
+        if not chunk:
+            break
         
-        rows[i] = ",".join(row)
- 
-    print "INSERT INTO %s (%s) VALUES\n" % (name,",".join(insert_header))
-    rows = map(lambda x:"\t(%s)" % x, rows)
-    rows = ",\n".join(rows)
-    print "%s;\n\n" % rows
+        values = ",\n".join(["\t(%s)" % ",".join(row) for row in chunk])
+        sql = "%s\n%s;\n\n\n" % (stmt,values)
+        sql = sql.encode("utf-8") if type(sql) is unicode else sql
+        out.write(sql)
+        STATS.count("bytes_written", len(sql))
+        n += len(chunk)
+    
+    return n
+
+def sql_insert(name, data, sql_types, vid=None, row_max=ROW_INSERT_MAX, db=None, out=None):
+    '''Output a SAS file as INSERT statements (to out, default stdout) or,
+    if a database loader is provided, load it directly.
+    '''
+    return sql_emit(name, sas_batches(data, vid), sql_types, row_max, db, out)
+   
+def enrollees_sql_insert(name, data, sql_types, row_max=ROW_INSERT_MAX, db=None, out=None):
+    '''Output Enrollees data as INSERT statements (to out, default stdout)
+    or, if a database loader is provided, load it directly.
+    '''
+    return sql_emit(name, enrollees_batches(data), sql_types, row_max, db, out)
 
 
+# image assessment data sets, several rows per subject and visit
+IMAGE_GROUP_REGEX = re.compile("^(k|fl)(XR|MRI)_")
+
 primary_key_defs = {}
 primary_key_defs["Accelerometry"] = ["id"]
 primary_key_defs["Biomarkers"] = ["id","vid"]
@@ -221,123 +416,743 @@ primary_key_defs["kXR_SQ_Rel_BU"] = []
 
 
 
-def main(args):
+def open_group(inputdir, files, reader="sas7bdat"):
+    '''Open the SAS member of every zip archive in a data set group using
+    the given reader backend. Archives that don't contain exactly one SAS 
+    file are skipped (None).
+    '''
+    members = []
+    for zipfname in files:
+        
+        filename = "%s%s" % (inputdir,zipfname)
+        zf = zipfile.ZipFile(filename, 'r')
+        manifest = sorted(zf.namelist())
+        sasfiles = [x for x in manifest if "sas7bdat" in x]
+        
+        if len(sasfiles) != 1:
+            zf.close()
+            members += [None]
+            continue
+        
+        members += [READERS[reader](zf, sasfiles[0])]
     
-    filelist = [x for x in os.listdir(args.inputdir) 
-                if os.path.isfile(args.inputdir+x) and ".zip" in x]
+    return members
+
+def infer_sql_types(members):
+    '''Infer SQL column types and labels for a data set group using the SAS
+    header and the buffered prefix batches of each member. Numeric columns
+    are stored as:
     
-    filelist = group_by_filename(filelist)
-  
-    for grp in filelist:
+      - REAL if stored in at most 4 bytes by SAS (truncated doubles keep 
+        at most 20 mantissa bits, so they fit a float exactly)
+      - DOUBLE PRECISION otherwise
+    
+    Integer code columns are only narrowed once loaded (see narrow_codes), 
+    as the prefix can't tell whether the whole column holds whole numbers.
+    '''
+    bdatfmt = {}
+    var_map,var_fmt,var_labels,var_decl,var_len = {},{},{},{},{}
+    
+    for d in members:
         
-        # skip these data sets as they require special handing
-        if grp in ["AllClinical","AccelData"]:
+        if d is None:
             continue
         
-        # create tmp directory for 
-        tmp_dir = "%s%s/" % (TMP_ROOT,grp)
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
-        
-        bdatfmt = {}
-        var_map,var_fmt,var_labels = {},{},{}
+        # SAS header format
+        var_ids = [(col.name,col.format,col.label,col.type,col.length) for col in d.columns]
+        for var,dtype,label,decl,length in var_ids:
+            key = norm_col_name(var) if var not in ["ID","VERSION"] else var.lower()
+            if key not in var_map:
+                var_map[key] = {}
+                var_fmt[key] = {}
+                var_labels[key] = []
+            var_map[key][var] = 1
+            var_fmt[key][dtype] = 1
+            var_labels[key] += [label]
+            var_decl[key] = decl
+            var_len[key] = max(var_len.get(key,0), length or 8)
+            
+        # types actually created by sas2bdat (NULLs carry no type information)
+        header = [norm_col_name(col.name) for col in d.columns]
+        for batch in d.prefix:
+            for j,col in enumerate(batch):
+                for t,n in column_types(col).items():
+                    if header[j] not in bdatfmt:
+                        bdatfmt[header[j]] = {}
+                    bdatfmt[header[j]][t] = bdatfmt[header[j]].get(t,0) + n
         
-        for i,zipfname in enumerate(filelist[grp]):
+    # normalize labels
+    for var in var_labels:
+        var_labels[var] = norm_col_label(var_labels[var])
             
-            filename = "%s%s" % (args.inputdir,zipfname)
-            zf = zipfile.ZipFile(filename, 'r')
-            manifest = sorted(zf.namelist())
-            sasfiles = [x for x in manifest if "sas7bdat" in x]
+    var_fmt["id"] = var_fmt["version"] = {"$":1}
+    
+    # assign majority type as column data type
+    for var in bdatfmt:
+        types = sorted(bdatfmt[var].items(),key=operator.itemgetter(1),reverse=1)
+        bdatfmt[var] = types[0][0] 
+        
+    # use this as a data type in SQL schema. Columns with no values in
+    # the buffered prefix fall back to their declared SAS type
+    sql_types = {}
+    for var in var_fmt:
+        if var not in bdatfmt:
+            bdatfmt[var] = unicode if var_decl.get(var) == "string" else float
+      
+        if bdatfmt[var] in [unicode,str]:
+            sql_types[var] = "TEXT"
+        elif var_len.get(var,8) <= 4:
+            sql_types[var] = "REAL"
+        else:
+            sql_types[var] = "DOUBLE PRECISION"
+        
+        if "MMDDYY" in var_fmt[var]:
+            sql_types[var] = "DATE"
+    
+    return sql_types, var_labels
+
+def var_codes(db):
+    '''Map nominal variables whose labelset (from the vardefs metadata 
+    table) only has integer values to the smallest integer SQL type. Empty 
+    if the metadata tables haven't been loaded.
+    '''
+    if not db or "vardefs" not in db.tables():
+        return {}
+    
+    sql = "SELECT var_id, labelset FROM vardefs WHERE type = 'nominal'"
+    sql += " AND labelset IS NOT NULL;"
+    
+    codes = {}
+    for var,labelset in db.query(sql):
+        values = [x for x in labelset.split("|") if x != "none"]
+        if not values or [x for x in values if not re.match("^-?\d+$",x)]:
+            continue
+        sql_type = integer_type(map(int,values))
+        if sql_type:
+            codes[var] = sql_type
+    
+    return codes
+
+def narrow_codes(name, sql_types, codes, db=None):
+    '''Narrow the loaded code columns of table name to their integer type
+    (see var_codes) where every value fits. Returns the updated column 
+    types. Codes are only known when loading into a database.
+    '''
+    code_types = {var:codes[var] for var in codes 
+                  if sql_types.get(var) in ["REAL","DOUBLE PRECISION"]}
+    if not db or not code_types:
+        return sql_types
+    
+    with STATS.timed("narrow"):
+        narrowed = db.narrow_columns(name, code_types)
+    
+    sql_types = dict(sql_types)
+    sql_types.update(narrowed)
+    return sql_types
+
+def group_schema(grp, members, backend="postgres"):
+    '''Build the SQL types, column labels and CREATE TABLE schema for a 
+    data set group. Column types are translated for the database backend.
+    '''
+    with STATS.timed("infer"):
+        sql_types, var_labels = infer_sql_types(members)
+        
+    # manually add visit column to tables containing
+    # multiple visits
+    if grp not in ["Outcomes"]:
+        sql_types["vid"] = "SMALLINT"
+    
+    pkeys = primary_key_defs[grp] if grp in primary_key_defs else []
+    schema = backend_table_schema(grp, sql_types, var_labels, pkeys, backend)
+    
+    return sql_types, var_labels, schema
+
+def backend_table_schema(name, sql_types, var_labels, pkeys, backend="postgres"):
+    '''CREATE TABLE schema with column types translated for the backend
+    '''
+    loader = LOADERS[backend]
+    return create_table_schema(name,loader.map_types(sql_types),var_labels,pkeys,
+                               comments=loader.native_comments)
+
+def load_plan(grp, members):
+    '''List the (member index, vid) pairs to load for a data set group
+    '''
+    # Enrollees and groups with only 1 file (don't use VID)
+    if grp == "Enrollees" or len(members) == 1:
+        return [(0,None)]
+    
+    return [(i,i) for i,d in enumerate(members) if d is not None]
+
+def visit_code(zipfname):
+    '''Visit number of a source file (3 for JointSx03_SAS.zip), or None
+    '''
+    match = re.search("(\d+)_SAS$", zipfname.split("/")[-1].split(".")[0])
+    return int(match.group(1)) if match else None
+
+def visits_sql(tables, files, plan):
+    '''Statements recording the visit of every vid of tables, loaded from
+    files according to plan (see load_plan)
+    '''
+    names = [x.lower() for x in tables]
+    sql = ["DELETE FROM %s WHERE table_name IN (%s);" % (VISITS_TABLE, 
+                                                          ",".join(["'%s'" % x for x in names]))]
+    
+    visits = [(vid,visit_code(files[i])) for i,vid in plan if vid != None]
+    values = ["('%s',%d,%d)" % (name,vid,visit) for name in names 
+              for vid,visit in visits if visit != None]
+    if values:
+        sql += ["INSERT INTO %s VALUES %s;" % (VISITS_TABLE, ",".join(values))]
+    
+    return sql
+
+def has_observations(grp):
+    '''True if group is added to the observations table: data sets with 
+    one row per subject and visit, and the image assessment data sets (rows
+    per knee side and read project are told apart by their row_num). 
+    AllClinical is left out, its variables duplicate those of the 
+    per-domain data sets.
+    '''
+    return primary_key_defs.get(grp) == ["id","vid"] or bool(IMAGE_GROUP_REGEX.match(grp))
+
+def load_member(grp, data, sql_types, vid=None, db=None, out=None, observations=False):
+    '''Load a single SAS file, returning the number of rows loaded. If 
+    observations is set, its values are also loaded into the observations 
+    table (after the file itself, from the same decoded batches).
+    '''
+    if grp == "Enrollees":
+        batches = enrollees_batches(data)
+    else:
+        batches = sas_batches(data, vid)
+    
+    spool = ObservationSpool(grp, TMP_ROOT) if observations else None
+    if spool:
+        batches = spool.tee(batches, sql_types)
+    
+    n = sql_emit(grp, batches, sql_types, db=db, out=out)
+    if spool:
+        sql_emit(OBSERVATIONS_TABLE, spool.batches(), OBSERVATIONS_TYPES, db=db, out=out)
+    
+    STATS.count("rows", n)
+    return n
+
+def changed_group(manifest, grp, checksums):
+    '''True if group must be (re)imported
+    '''
+    if is_current(manifest, grp, checksums):
+        STATS.log(" (skipping) %s unchanged" % grp)
+        return False
+    return True
+
+def var_categories(db):
+    '''Map variable -> category name, using the category assignments loaded
+    by metadata.py. Variables in several categories are assigned to the 
+    first one.
+    '''
+    if "varcategories" not in db.tables():
+        return {}
+    
+    sql = "SELECT varcategories.var_id, categorydefs.name FROM varcategories, categorydefs"
+    sql += " WHERE varcategories.cat_id = categorydefs.id AND categorydefs.type = 1"
+    sql += " ORDER BY categorydefs.id;"
+    
+    categories = {}
+    for var,name in db.query(sql):
+        categories.setdefault(var,name)
+    return categories
+
+def partition_name(grp, category):
+    
+    return "%s_%s" % (grp, re.sub("[^a-z0-9]+","_",category.lower()).strip("_"))
+
+def partition_columns(grp, sql_types, categories):
+    '''Split group columns into a subject/visit key table and one table 
+    per variable category (uncategorized variables go to *_other). Returns 
+    dictionary of table name -> columns.
+    '''
+    tables = {"%s_keys" % grp:[x for x in PARTITION_KEYS if x in sql_types]}
+    for var in sorted(sql_types):
+        if var in PARTITION_KEYS:
+            continue
+        name = partition_name(grp, categories.get(var,"other"))
+        tables[name] = tables.get(name,["id","vid"]) + [var]
+    
+    return tables
+
+def partition_batches(data, vid, tables):
+    '''Split the column batches of a SAS file by table, yielding (table, 
+    header, columns) for each batch and table. Category tables without any
+    columns in this file are skipped.
+    '''
+    batches = sas_batches(data, vid)
+    index = {var:j for j,var in enumerate(next(batches))}
+    
+    split = []
+    for name in sorted(tables):
+        header = [x for x in tables[name] if x in index]
+        if name.endswith("_keys") or [x for x in header if x not in PARTITION_KEYS]:
+            split += [(name,header,[index[x] for x in header])]
+    
+    for cols in batches:
+        for name,header,src in split:
+            yield name, header, [cols[j] for j in src]
+
+def load_partitions(grp, data, vid, tables, sql_types, db):
+    '''Load a single SAS file into its partition tables, returning the 
+    number of rows loaded
+    '''
+    n = 0
+    for name,header,cols in partition_batches(data, vid, tables):
+        rows = db.load(name, header, iter([cols]), sql_types)
+        if name == "%s_keys" % grp:
+            n += rows
+    
+    STATS.count("rows", n)
+    return n
+
+def partition_view(grp, viewname, columns, vid, tables):
+    '''Joining view of a single visit, with the original column names of
+    its SAS file
+    '''
+    keys = "%s_keys" % grp
+    owner = {var:name for name in tables for var in tables[name] if var not in PARTITION_KEYS}
+    aliases = {name:"t%d" % i for i,name in enumerate(sorted(tables))}
+    
+    select, joins = ["k.id"], {}
+    for col in columns:
+        var = norm_col_name(col) if col not in ["id","version"] else col
+        if var == "version":
+            select += ["k.version"]
+        if var not in owner:
+            continue
+        alias = aliases[owner[var]]
+        select += ["%s.%s AS %s" % (alias,var,col.lower())]
+        joins[owner[var]] = alias
+    
+    sql = "CREATE VIEW %s AS SELECT\n\t%s\nFROM %s k" % (viewname,",\n\t".join(select),keys)
+    for name in sorted(joins):
+        alias = joins[name]
+        sql += "\nLEFT JOIN %s %s ON (%s.id = k.id AND %s.vid = k.vid)" % (name,alias,alias,alias)
+    sql += "\nWHERE k.vid = %d;" % vid
+    
+    return sql, len(select)
 
-            if len(sasfiles) > 1:
+def partition_views(grp, viewname, columns, vid, tables, column_max=None):
+    '''Joining views of a single visit (see partition_view), as a list of
+    (name, sql). Views wider than column_max are split into views named 
+    viewname_1, viewname_2, ... holding the columns of consecutive tables.
+    '''
+    sql, ncols = partition_view(grp, viewname, columns, vid, tables)
+    if not column_max or ncols <= column_max:
+        return [(viewname, sql)]
+    
+    owner = {var:name for name in tables for var in tables[name] if var not in PARTITION_KEYS}
+    var = lambda col:norm_col_name(col) if col not in ["id","version"] else col
+    
+    # id and version are repeated in every view
+    keys = [col for col in columns if var(col) == "version"]
+    cols = [col for col in columns if var(col) in owner]
+    cols = sorted(cols, key=lambda col:owner[var(col)])
+    
+    n = column_max - 1 - len(keys)
+    views = []
+    for i in range(0, len(cols), n):
+        name = "%s_%d" % (viewname, len(views) + 1)
+        views += [(name, partition_view(grp, name, keys + cols[i:i+n], vid, tables)[0])]
+    
+    return views
+
+def partition_main(args, filelist, db, manifest=None):
+    '''Import PARTITION_GROUPS data sets. Columns are split by variable
+    category (read from the metadata tables, so metadata.py must be run 
+    first) into narrow tables keyed by id,vid. A view per source file joins
+    them back together under the original column names.
+    '''
+    for grp in PARTITION_GROUPS:
+        
+        if grp not in filelist:
+            continue
+        
+        if not db:
+            STATS.log(" (skipping) %s requires --dbname" % grp)
+            continue
+        
+        if manifest != None:
+            checksums = file_checksums(args.inputdir, filelist[grp])
+            if not changed_group(manifest, grp, checksums):
                 continue
+        
+        categories, codes = var_categories(db), var_codes(db)
+        if not categories:
+            STATS.log(" (warning) no variable categories found, run metadata.py first")
+        
+        with STATS.track(grp):
             
-            # dump SAS to a temporary file
-            data = zf.read(sasfiles[0])
-            tmpfile = "%s%s.sas7bdat" % (tmp_dir,i)
-            with open(tmpfile,"wb") as tmp:
-                tmp.write(data)
+            members = open_group(args.inputdir, filelist[grp], args.reader)
+            with STATS.timed("infer"):
+                sql_types, var_labels = infer_sql_types(members)
+            sql_types["vid"] = "SMALLINT"
             
-            d = sas7bdat.SAS7BDAT(tmpfile)
+            tables = partition_columns(grp, sql_types, categories)
             
-            # SAS header format
-            var_ids = [(col.name,col.format,col.label) for col in d.header.parent.columns]
-            for var,dtype,label in var_ids:
-                key = norm_col_name(var) if var not in ["ID","VERSION"] else var.lower()
-                if key not in var_map:
-                    var_map[key] = {}
-                    var_fmt[key] = {}
-                    var_labels[key] = []
-                var_map[key][var] = 1
-                var_fmt[key][dtype] = 1
-                var_labels[key] += [label]
-                
-            # types actually created by sas2bdat
-            header = [norm_col_name(col.name) for col in d.header.parent.columns]
-            for idx,row in enumerate(d):
-                if idx == 0:
-                    continue
-                
-                for j in range(0,len(row)):
-                    t = type(row[j])
-                    if header[j] not in bdatfmt:
-                        bdatfmt[header[j]] = {}
-                    bdatfmt[header[j]][t] = bdatfmt[header[j]].get(t,0) + 1
+            # tables of a previous import may use other categories
+            if manifest != None:
+                prev = manifest["groups"].get(grp,{}).get("schema",{})
+                invalidate_group(args.manifest, manifest, grp)
+                for name in sorted({x:1 for x in prev.keys() + tables.keys()}):
+                    db.drop_table(name)
             
-        # normalize labels
-        for var in var_labels:
-            var_labels[var] = norm_col_label(var_labels[var])
-                
+            for name in sorted(tables):
+                types = {x:sql_types[x] for x in tables[name]}
+                labels = {x:var_labels[x] for x in tables[name] if x in var_labels}
+                db.execute(backend_table_schema(name, types, labels, ["id","vid"], args.backend))
+                db.comment_columns(name, labels)
+            
+            rows = 0
+            plan = load_plan(grp, members)
+            for sql in visits_sql(sorted(tables), filelist[grp], plan):
+                db.execute(sql)
+            for i,vid in plan:
+                with STATS.track(grp, filelist[grp][i], residual="emit") as rec:
+                    rows += load_partitions(grp, members[i], vid, tables, sql_types, db)
+                STATS.log_record(rec)
+            
+            # code columns are narrowed before the views depend on them
+            for name in sorted(tables):
+                types = {x:sql_types[x] for x in tables[name]}
+                sql_types.update(narrow_codes(name, types, codes, db))
+            
+            for i,vid in plan:
+                viewname = re.sub("_SAS$","",filelist[grp][i].split("/")[-1].split(".")[0])
+                columns = [col.name for col in members[i].columns]
+                views = partition_views(grp, viewname, columns, vid, tables, db.column_max)
+                if len(views) > 1:
+                    STATS.log(" (warning) %s exceeds %d columns, split into views %s" % 
+                              (viewname, db.column_max, ", ".join([x for x,sql in views])))
                 
-        var_fmt["id"] = var_fmt["version"] = {"$":1}
-        
-        # assign majority type as column data type
-        for var in bdatfmt:
-            types = sorted(bdatfmt[var].items(),key=operator.itemgetter(1),reverse=1)
-            bdatfmt[var] = types[0][0] 
+                db.execute("DROP VIEW IF EXISTS %s;" % viewname)
+                for name,sql in views:
+                    db.execute("DROP VIEW IF EXISTS %s;" % name)
+                    db.execute(sql)
             
-        # confirm consistent data types across all fields
-        # use this as a data type in SQL schema
-        sql_types = {}
-        for var in var_fmt:
-            if var not in bdatfmt:
-                sys.stderr.write("FATAL ERROR -- exiting")
-                sys.stderr.write("%s %s" % (grp, var))
-                sys.exit()
-          
-            sql_types[var] = "TEXT" if bdatfmt[var] in [unicode,str] else "NUMERIC"
+            db.commit()
+        
+        if manifest != None:
+            schema = {name:{x:sql_types[x] for x in tables[name]} for name in tables}
+            record_group(args.manifest, manifest, grp, checksums, schema, rows)
+
+def timeseries_main(args, filelist, manifest=None):
+    '''Import TIMESERIES_GROUPS data sets into chunked, compressed stores
+    (one per group) in args.tsdir. Files are streamed in batches, so memory
+    use is bounded by the store's chunk size.
+    '''
+    for grp in TIMESERIES_GROUPS:
+        
+        if grp not in filelist:
+            continue
+        
+        if not args.tsdir:
+            STATS.log(" (skipping) %s requires --tsdir" % grp)
+            continue
+        
+        if manifest != None:
+            checksums = file_checksums(args.inputdir, filelist[grp])
+            if not changed_group(manifest, grp, checksums):
+                continue
+            invalidate_group(args.manifest, manifest, grp)
+        
+        members = [(f,d) for f,d in zip(filelist[grp], 
+                                        open_group(args.inputdir, filelist[grp], args.reader))
+                   if d is not None]
+        if not members:
+            continue
+        
+        # the store's columns are those of the first file
+        columns = members[0][1].columns
+        names = [norm_col_name(col.name) for col in columns]
+        kinds = map(column_kind, columns)
+        
+        with STATS.track(grp):
+            store = TimeSeriesWriter(os.path.join(args.tsdir,grp.lower()), names, kinds)
             
-            if "MMDDYY" in var_fmt[var]:
-                sql_types[var] = "DATE"
+            for zipfname,data in members:
+                with STATS.track(grp, zipfname, residual="emit") as rec:
+                    index = {norm_col_name(col.name):j for j,col in enumerate(data.columns)}
+                    for batch in data.batches():
+                        n = len(batch[0]) if batch else 0
+                        null = np.array([None] * n, dtype=object)
+                        with STATS.timed("encode"):
+                            store.append([batch[index[x]] if x in index else null 
+                                          for x in names])
+                        STATS.count("rows", n)
+                STATS.log_record(rec)
             
-        # manually add visit column to tables containing
-        # multiple visits
-        if grp not in ["Outcomes"]:
-            sql_types["vid"] = "INTEGER"
+            rows = store.close()
+        
+        if manifest != None:
+            record_group(args.manifest, manifest, grp, checksums, zip(names,kinds), rows)
+
+def schema_worker(task):
+    '''Pool worker: infer the schema of a single data set group
+    '''
+    grp, inputdir, files, reader, backend = task
+    
+    with STATS.track(grp) as rec:
+        members = open_group(inputdir, files, reader)
+        sql_types, var_labels, schema = group_schema(grp, members, backend)
+        plan = load_plan(grp, members)
+        
+        for d in members:
+            if d is not None:
+                d.close()
+    
+    return sql_types, var_labels, schema, plan, rec
+
+def load_worker(task):
+    '''Pool worker: load a single SAS file. Data is either copied directly 
+    into the database or spooled as SQL to a temp file, whose name is 
+    returned (with the row count and timing record) so the coordinator can 
+    output it in order.
+    '''
+    grp, inputdir, zipfname, vid, sql_types, dbname, reader, backend, observations = task
+    
+    with STATS.track(grp, zipfname, residual="emit") as rec:
+        data = open_group(inputdir, [zipfname], reader)[0]
+        
+        if dbname:
+            db = LOADERS[backend](dbname, STATS)
+            n = load_member(grp, data, sql_types, vid=vid, db=db, 
+                            observations=observations)
+            db.commit()
+            db.close()
+            spool = None
+        
+        else:
+            spool = tempfile.NamedTemporaryFile(prefix="%s." % grp, suffix=".sql", 
+                                                dir=TMP_ROOT, delete=False)
+            with spool:
+                n = load_member(grp, data, sql_types, vid=vid, out=spool,
+                                observations=observations)
+            spool = spool.name
+    
+    return spool, n, rec
+
+def parallel_main(args, filelist, db, manifest=None):
+    '''Import data set groups using a pool of worker processes. Schemas are
+    inferred per group, then every file is loaded as a separate task. Output
+    order is the same as the serial import.
+    '''
+    pool = multiprocessing.Pool(args.jobs)
+    
+    groups = [grp for grp in sorted(filelist) 
+              if grp not in SKIP_GROUPS + PARTITION_GROUPS + TIMESERIES_GROUPS]
+    
+    checksums = {}
+    if manifest != None:
+        checksums = {grp:file_checksums(args.inputdir, filelist[grp]) for grp in groups}
+        groups = [grp for grp in groups if changed_group(manifest, grp, checksums[grp])]
+    
+    codes = var_codes(db)
+    tasks = [(grp, args.inputdir, filelist[grp], args.reader, args.backend) 
+             for grp in groups]
+    schemas = pool.map(schema_worker, tasks)
+    
+    # schemas are executed up front when loading directly; when outputting 
+    # SQL each schema is output right before the first file of its group
+    tasks, schema_at = [], {}
+    remaining, rows = {}, {}
+    for grp,(sql_types,var_labels,schema,plan,rec) in zip(groups,schemas):
+        STATS.merge(rec)
         
-        pkeys = primary_key_defs[grp] if grp in primary_key_defs else []
-        schema = create_table_schema(grp,sql_types,var_labels,pkeys) 
+        observations = args.observations and has_observations(grp)
         
-        print schema
+        visits = visits_sql([grp], filelist[grp], plan)
+        if db:
+            if manifest != None:
+                invalidate_group(args.manifest, manifest, grp)
+                db.drop_table(grp)
+                if observations:
+                    db.execute(clear_sql(grp))
+            db.execute(schema)
+            db.comment_columns(grp, var_labels)
+            for sql in visits:
+                db.execute(sql)
+        else:
+            schema_at[len(tasks)] = schema_at.get(len(tasks),[]) + [schema] + visits
+        
+        remaining[grp], rows[grp] = len(plan), 0
+        for i,vid in plan:
+            tasks += [(grp, args.inputdir, filelist[grp][i], vid, sql_types, 
+                       args.dbname, args.reader, args.backend, observations)]
+    
+    if db:
+        db.commit()
+    
+    # imap preserves task order, so spooled SQL is output deterministically
+    for i,(spool,n,rec) in enumerate(pool.imap(load_worker, tasks)):
+        for schema in schema_at.pop(i,[]):
+            print schema
+            print
+        
+        STATS.merge(rec)
+        STATS.log_record(rec)
+        
+        if spool:
+            with open(spool,"rb") as f:
+                shutil.copyfileobj(f, sys.stdout)
+            os.remove(spool)
+        
+        # code columns are narrowed and groups recorded only once all their
+        # files are loaded
+        grp = tasks[i][0]
+        remaining[grp] -= 1
+        rows[grp] += n
+        if remaining[grp] == 0:
+            sql_types = narrow_codes(grp, tasks[i][4], codes, db)
+            if db:
+                db.commit()
+            if manifest != None:
+                record_group(args.manifest, manifest, grp, checksums[grp], sql_types, rows[grp])
+    
+    # groups without any data files
+    for i in sorted(schema_at):
+        for schema in schema_at[i]:
+            print schema
+            print
+    
+    pool.close()
+    pool.join()
+
+def finish_observations(args, db):
+    '''Index the observations table once all groups are loaded
+    '''
+    if not args.observations:
+        return
+    
+    if not db:
+        print index_sql()
+        return
+    
+    db.execute(index_sql())
+    db.commit()
+
+def finish_generation(db):
+    '''Mark the database as (re)loaded
+    '''
+    if not db:
+        print GENERATION_SQL
+        return
+    
+    db.bump_generation()
+
+def main(args):
+    
+    filelist = [x for x in os.listdir(args.inputdir) 
+                if os.path.isfile(args.inputdir+x) and ".zip" in x]
+    
+    filelist = group_by_filename(filelist)
+    
+    # load directly into the database (or embedded database file)
+    db = LOADERS[args.backend](args.dbname, STATS) if args.dbname else None
+    
+    # incremental import: only (re)load groups whose source files changed
+    manifest = load_manifest(args.manifest) if args.manifest else None
+    
+    STATS.logging = args.logging
+    
+    # visits of the tables of multi-file groups
+    if db:
+        db.execute(VISITS_SCHEMA)
+        db.commit()
+    else:
+        print VISITS_SCHEMA
         print
+    
+    # long-format observations table (shared by all groups)
+    if args.observations:
+        if db:
+            db.execute(OBSERVATIONS_SCHEMA)
+            db.commit()
+        else:
+            print OBSERVATIONS_SCHEMA
+    
+    # embedded database files only allow a single writer process
+    if args.jobs > 1 and db and not db.parallel:
+        STATS.log(" (warning) %s databases are loaded serially" % args.backend)
+        args.jobs = 1
+    
+    if args.jobs > 1:
+        parallel_main(args, filelist, db, manifest)
+        partition_main(args, filelist, db, manifest)
+        timeseries_main(args, filelist, manifest)
+        finish_observations(args, db)
+        finish_generation(db)
+        if db:
+            db.close()
+        if args.report:
+            STATS.write(args.report)
+        return
+  
+    # integer codes of nominal variables (requires metadata tables)
+    codes = var_codes(db)
+    
+    for grp in sorted(filelist):
         
-        if grp == "Enrollees":
-            tmpfile = "%s%s.sas7bdat" % (tmp_dir,0)
-            data = sas7bdat.SAS7BDAT(tmpfile)
-            enrollees_sql_insert(grp, data, sql_types)
+        # skip these data sets as they require special handing
+        if grp in SKIP_GROUPS + PARTITION_GROUPS + TIMESERIES_GROUPS:
             continue
         
-        # only 1 file (don't use VID)
-        if len(filelist[grp]) == 1:
-            tmpfile = "%s%s.sas7bdat" % (tmp_dir,0)
-            data = sas7bdat.SAS7BDAT(tmpfile)
-            sql_insert(grp, data, sql_types, vid=None)
-            continue
+        if manifest != None:
+            checksums = file_checksums(args.inputdir, filelist[grp])
+            if not changed_group(manifest, grp, checksums):
+                continue
+        
+        with STATS.track(grp):
+            
+            # every SAS member is streamed from its archive and decoded once
+            members = open_group(args.inputdir, filelist[grp], args.reader)
+            sql_types, var_labels, schema = group_schema(grp, members, args.backend)
+            observations = args.observations and has_observations(grp)
+            plan = load_plan(grp, members)
+            
+            if db:
+                if manifest != None:
+                    invalidate_group(args.manifest, manifest, grp)
+                    db.drop_table(grp)
+                    if observations:
+                        db.execute(clear_sql(grp))
+                db.execute(schema)
+                db.comment_columns(grp, var_labels)
+                for sql in visits_sql([grp], filelist[grp], plan):
+                    db.execute(sql)
+            else:
+                for sql in [schema] + visits_sql([grp], filelist[grp], plan):
+                    print sql
+                    print
+            
+            rows = 0
+            for i,vid in plan:
+                with STATS.track(grp, filelist[grp][i], residual="emit") as rec:
+                    rows += load_member(grp, members[i], sql_types, vid=vid, db=db,
+                                        observations=observations)
+                STATS.log_record(rec)
+            
+            sql_types = narrow_codes(grp, sql_types, codes, db)
+            if db:
+                db.commit()
         
-        for i in range(0,len(filelist[grp])):
-            tmpfile = "%s%s.sas7bdat" % (tmp_dir,i)
-            data = sas7bdat.SAS7BDAT(tmpfile)
-            sql_insert(grp, data, sql_types, vid=i)
+        if manifest != None:
+            record_group(args.manifest, manifest, grp, checksums, sql_types, rows)
+    
+    partition_main(args, filelist, db, manifest)
+    timeseries_main(args, filelist, manifest)
+    finish_observations(args, db)
+    finish_generation(db)
+    
+    if db:
+        db.close()
+    
+    if args.report:
+        STATS.write(args.report)
                        
         
 
@@ -346,14 +1161,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-i","--inputdir", type=str, 
                         help="data set input directory")
+    parser.add_argument("-d","--dbname", type=str, 
+                        help="load directly into this database, or database file for embedded backends (no SQL output)")
+    parser.add_argument("-b","--backend", type=str, default="postgres", 
+                        choices=sorted(LOADERS.keys()), help="database backend")
+    parser.add_argument("--manifest", type=str, 
+                        help="import manifest file; only changed data sets are reloaded (requires --dbname)")
+    parser.add_argument("-r","--reader", type=str, default="sas7bdat", 
+                        choices=sorted(READERS.keys()), help="SAS reader backend")
+    parser.add_argument("-t","--tsdir", type=str, 
+                        help="directory for time series stores (AccelData)")
+    parser.add_argument("-o","--observations", action='store_true', 
+                        help="also load subject/visit data sets into the long-format observations table")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+                        help="number of worker processes")
     parser.add_argument("-m","--no-metadata", action='store_false', dest="metadata",
                         help="output metadata schema")   
     parser.add_argument("-l","--no-logging", action='store_false', dest="logging",
-                        help="disable logging")            
+                        help="disable logging")
+    parser.add_argument("--report", type=str, 
+                        help="write JSON timing report to this file")            
     args = parser.parse_args()
 
     # argument error, exit
-    if not args.inputdir:
+    if not args.inputdir or (args.manifest and not args.dbname):
         parser.print_help()
         sys.exit()
    
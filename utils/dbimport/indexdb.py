@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Post-load index and statistics builder. Creates secondary indexes on
+subject/visit keys, the side/read project columns of image assessment
+tables and the metadata tables, clusters the observations table, then runs
+ANALYZE and reports which tables got which indexes. Safe to re-run after
+incremental loads: existing indexes are left untouched.
+'''
+import re
+import sys
+import argparse
+import psycopg2
+
+from observations import OBSERVATIONS_TABLE, OBSERVATIONS_INDEX
+from loaders import VISITS_TABLE
+
+# image assessment data sets (kXR_*, kMRI_*, flXR_*)
+IMAGE_TABLE_REGEX = re.compile("^(k|fl)(xr|mri)_")
+
+# secondary indexes on metadata tables
+METADATA_INDEXES = [("varcategories",["cat_id"]), ("vardefs",["dataset"])]
+
+# tables physically ordered by an index (createdb.py --observations), so 
+# fetching a set of variables reads contiguous pages
+CLUSTER_INDEXES = [(OBSERVATIONS_TABLE,OBSERVATIONS_INDEX)]
+
+def get_table_columns(cur):
+    '''Map public table name -> list of column names (views are ignored)
+    '''
+    sql = "SELECT table_name, column_name FROM information_schema.columns"
+    sql += " WHERE table_schema='public' AND table_name IN"
+    sql += " (SELECT table_name FROM information_schema.tables"
+    sql += " WHERE table_schema='public' AND table_type='BASE TABLE')"
+    sql += " ORDER BY table_name, ordinal_position;"
+    cur.execute(sql)
+
+    tables = {}
+    for table,column in cur.fetchall():
+        tables[table] = tables.get(table,[]) + [column]
+    return tables
+
+def get_primary_keys(cur):
+    '''Map public table name -> list of primary key columns
+    '''
+    sql = """SELECT tc.table_name, kcu.column_name
+    FROM information_schema.table_constraints AS tc
+    INNER JOIN information_schema.key_column_usage AS kcu
+        ON tc.constraint_name = kcu.constraint_name
+        AND tc.table_schema = kcu.table_schema
+    WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = 'public'
+    ORDER BY tc.table_name, kcu.ordinal_position;"""
+    cur.execute(sql)
+
+    pkeys = {}
+    for table,column in cur.fetchall():
+        pkeys[table] = pkeys.get(table,[]) + [column]
+    return pkeys
+
+def index_defs(tables, pkeys):
+    '''List (table, columns) indexes for all tables. Indexes duplicating
+    a primary key are skipped.
+    '''
+    defs = []
+    for table in sorted(tables):
+
+        # clustered tables only get their cluster index; the visit map has
+        # no subjects
+        if table in dict(CLUSTER_INDEXES) or table == VISITS_TABLE:
+            continue
+
+        columns = tables[table]
+        keys = [x for x in ["id","vid"] if x in columns]
+        image = IMAGE_TABLE_REGEX.search(table)
+
+        # image assessment tables are keyed by subject, visit and knee side
+        if image and keys and "side" in columns:
+            keys += ["side"]
+
+        # a primary key already indexes its leading columns
+        if keys and keys != pkeys.get(table,[])[:len(keys)]:
+            defs += [(table,keys)]
+
+        if image and "readprj" in columns:
+            defs += [(table,["readprj"])]
+
+    for table,columns in METADATA_INDEXES + CLUSTER_INDEXES:
+        if table in tables:
+            defs += [(table,columns)]
+
+    return defs
+
+def index_name(table, columns):
+
+    return "%s_%s_idx" % (table,"_".join(columns))
+
+def create_indexes(cur, defs):
+    '''Create indexes that don't exist yet. Returns list of
+    (table, index name, columns, created) tuples.
+    '''
+    cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname='public';")
+    existing = {x[0]:1 for x in cur.fetchall()}
+
+    report = []
+    for table,columns in defs:
+        name = index_name(table,columns)
+        created = name not in existing
+        if created:
+            sql = "CREATE INDEX %s ON %s (%s);" % (name,table,",".join(columns))
+            cur.execute(sql)
+        report += [(table,name,columns,created)]
+
+    return report
+
+def main(args):
+
+    con = psycopg2.connect(database=args.dbname, user='')
+    cur = con.cursor()
+
+    tables = get_table_columns(cur)
+    pkeys = get_primary_keys(cur)
+    report = create_indexes(cur, index_defs(tables, pkeys))
+
+    # rows loaded since the last CLUSTER are unordered, so always recluster
+    for table,columns in CLUSTER_INDEXES:
+        if table in tables:
+            cur.execute("CLUSTER %s USING %s;" % (table,index_name(table,columns)))
+
+    # refresh planner statistics
+    for table in sorted(tables):
+        cur.execute("ANALYZE %s;" % table)
+
+    con.commit()
+    con.close()
+
+    for table,name,columns,created in report:
+        status = "created" if created else "exists"
+        sys.stdout.write("%s: %s (%s) [%s]\n" % (table,name,",".join(columns),status))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d","--dbname", type=str, help="OAI database name")
+    args = parser.parse_args()
+
+    # argument error, exit
+    if not args.dbname:
+        parser.print_help()
+        sys.exit()
+
+    main(args)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Import pipeline instrumentation shared by createdb.py and metadata.py.
+Time is recorded per data set group and per file, split into pipeline
+stages (e.g., unzip, decode, infer, encode, emit), along with row and byte
+counts. Results are written as a JSON run report.
+'''
+import sys
+import time
+import json
+import resource
+import contextlib
+
+class TimedFile(object):
+    '''File wrapper recording time spent in and bytes returned by read()
+    '''
+    def __init__(self, fh, stats, stage="unzip"):
+        self.fh = fh
+        self.stats = stats
+        self.stage = stage
+
+    def read(self, *args):
+        t0 = time.time()
+        data = self.fh.read(*args)
+        self.stats.add(self.stage, time.time() - t0)
+        self.stats.count("bytes_read", len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+
+class ImportStats(object):
+    '''Collects timing records. Every record belongs to a data set group and
+    optionally a file. Stage times are added to the record currently being
+    tracked.
+    '''
+    def __init__(self, logging=True):
+        self.logging = logging
+        self.records = []
+        self.current = None
+        self.started = time.time()
+
+    def new_record(self, grp, filename=None):
+
+        return {"group":grp, "file":filename, "seconds":{}, "rows":0,
+                "bytes_read":0, "bytes_written":0}
+
+    @contextlib.contextmanager
+    def track(self, grp, filename=None, residual=None):
+        '''Track a group or file. Time not attributed to any stage is
+        assigned to the residual stage, if given.
+        '''
+        rec = self.new_record(grp, filename)
+        rec["nested"] = self.current != None
+        prev, self.current = self.current, rec
+        t0 = time.time()
+        try:
+            yield rec
+        finally:
+            total = time.time() - t0
+            if residual:
+                other = sum(rec["seconds"].values())
+                rec["seconds"][residual] = max(0.0, total - other)
+            rec["seconds"]["total"] = total
+            self.current = prev
+            self.records += [rec]
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - t0)
+
+    def seconds(self, stage):
+
+        return self.current["seconds"].get(stage,0.0) if self.current else 0.0
+
+    def add(self, stage, seconds):
+        if self.current != None:
+            self.current["seconds"][stage] = self.seconds(stage) + seconds
+
+    def count(self, key, n):
+        if self.current != None:
+            self.current[key] += n
+
+    def merge(self, rec):
+        '''Add a record collected by a worker process
+        '''
+        self.records += [rec]
+
+    def log(self, msg):
+        if self.logging:
+            sys.stderr.write("%s\n" % msg)
+
+    def log_record(self, rec):
+        secs = rec["seconds"].get("total",0.0)
+        rate = rec["rows"] / secs if secs else 0.0
+        self.log(" (+) %s %s: %d rows %.1fs (%d rows/s)" % (rec["group"],
+                 rec["file"] or "", rec["rows"], secs, rate))
+
+    def report(self):
+        '''Aggregate records into a run report
+        '''
+        groups = {}
+        for rec in self.records:
+            if rec["group"] not in groups:
+                groups[rec["group"]] = {"seconds":{}, "rows":0, "bytes_read":0,
+                                        "bytes_written":0, "files":[]}
+            grp = groups[rec["group"]]
+
+            # nested file times are already part of their group's total
+            for stage,secs in rec["seconds"].items():
+                if rec.get("nested") and stage == "total":
+                    continue
+                grp["seconds"][stage] = grp["seconds"].get(stage,0.0) + secs
+            for key in ["rows","bytes_read","bytes_written"]:
+                grp[key] += rec[key]
+            if rec["file"]:
+                grp["files"] += [rec]
+
+        run = {"seconds":{}, "rows":0, "bytes_read":0, "bytes_written":0}
+        for grp in groups.values():
+            secs = grp["seconds"].get("total",0.0)
+            grp["rows_per_sec"] = grp["rows"] / secs if secs else 0.0
+            for key in ["rows","bytes_read","bytes_written"]:
+                run[key] += grp[key]
+            for stage,secs in grp["seconds"].items():
+                run["seconds"][stage] = run["seconds"].get(stage,0.0) + secs
+
+        # total is wall clock time (group times overlap when run in parallel)
+        run["seconds"]["total"] = time.time() - self.started
+        run["rows_per_sec"] = run["rows"] / run["seconds"]["total"]
+
+        # ru_maxrss is KB on Linux (bytes on OS X)
+        run["peak_memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run["peak_memory_workers"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        run["groups"] = groups
+
+        return run
+
+    def write(self, filename):
+
+        with open(filename,"w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Column label normalization shared by createdb.py and metadata.py. Each
+variable has one SAS label per visit file; the normalized label is the
+longest substring common to all of them.
+'''
+
+# memoized normalized labels, keyed by label set
+_label_cache = {}
+
+def suffix_automaton(s):
+    '''Build the suffix automaton of s in linear time. Returns the
+    transition (list of dicts) and suffix link lists.
+    '''
+    trans, link, length = [{}], [-1], [0]
+    last = 0
+
+    for c in s:
+        cur = len(trans)
+        trans += [{}]
+        link += [0]
+        length += [length[last] + 1]
+
+        p = last
+        while p != -1 and c not in trans[p]:
+            trans[p][c] = cur
+            p = link[p]
+
+        if p != -1:
+            q = trans[p][c]
+            if length[p] + 1 == length[q]:
+                link[cur] = q
+            else:
+                clone = len(trans)
+                trans += [dict(trans[q])]
+                link += [link[q]]
+                length += [length[p] + 1]
+                while p != -1 and trans[p].get(c) == q:
+                    trans[p][c] = clone
+                    p = link[p]
+                link[q] = link[cur] = clone
+        last = cur
+
+    return trans, link, length
+
+def longest_common_substring(s1, s2):
+    '''Longest common substring in O(len(s1) + len(s2)). Ties are broken by
+    the earliest occurrence in s1.
+    '''
+    trans, link, length = suffix_automaton(s2)
+
+    state, n = 0, 0
+    longest, x_longest = 0, 0
+    for x,c in enumerate(s1):
+        while state and c not in trans[state]:
+            state = link[state]
+            n = length[state]
+        if c in trans[state]:
+            state = trans[state][c]
+            n += 1
+        else:
+            state, n = 0, 0
+
+        if n > longest:
+            longest = n
+            x_longest = x + 1
+
+    return s1[x_longest - longest: x_longest]
+
+def norm_col_label(labels):
+
+    labels = tuple([x for x in labels if x]) # remove null strs
+    if labels not in _label_cache:
+        label = reduce(longest_common_substring, labels) if labels else ""
+        _label_cache[labels] = label.strip(":").strip(".").strip()
+
+    return _label_cache[labels]
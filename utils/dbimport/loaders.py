@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Database loaders shared by createdb.py and metadata.py. A loader creates
+tables and bulk loads column batches into either a PostgreSQL server (using
+COPY) or an embedded database file (DuckDB, or SQLite from the standard
+library), so the OAI database can be used on a laptop without a server.
+
+Embedded databases don't support column comments, so column labels are
+stored in a colcomments table instead.
+'''
+import itertools
+import sqlite3
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+from instrument import ImportStats
+
+COLCOMMENTS_SCHEMA = """CREATE TABLE IF NOT EXISTS colcomments (
+\ttable_name TEXT NOT NULL,
+\tcolumn_name TEXT NOT NULL,
+\tdescription TEXT,
+\tPRIMARY KEY(table_name,column_name));"""
+
+# load generation, incremented after every import so clients caching
+# metadata (datasets.oai.VariableCatalog) know when to reload it
+GENERATION_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS loadgeneration (generation INTEGER NOT NULL);",
+    "INSERT INTO loadgeneration SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM loadgeneration);",
+    "UPDATE loadgeneration SET generation = generation + 1;"]
+GENERATION_SQL = "\n".join(GENERATION_STATEMENTS)
+
+# visit of every vid of the tables of multi-file groups: vids number the
+# files of a group, so groups collected at different visits number them
+# differently (datasets.oai.CategoryFeatureBuilder aligns tables with it)
+VISITS_TABLE = "tablevisits"
+VISITS_SCHEMA = """CREATE TABLE IF NOT EXISTS tablevisits (
+\ttable_name VARCHAR(64) NOT NULL,
+\tvid SMALLINT NOT NULL,
+\tvisit SMALLINT NOT NULL);"""
+
+# integer code columns are loaded as REAL/DOUBLE PRECISION and narrowed to
+# their integer type once the whole column is loaded (Loader.narrow_columns)
+INTEGER_RANGES = {"SMALLINT":(-2**15, 2**15-1), "INTEGER":(-2**31, 2**31-1)}
+
+def misfit_sql(var, sql_type):
+    '''Condition on rows whose value of var doesn't fit integer sql_type
+    '''
+    lo, hi = INTEGER_RANGES[sql_type]
+    return "(%s <> trunc(%s) OR %s NOT BETWEEN %d AND %d)" % (var,var,var,lo,hi)
+
+def psql_esc_str(s):
+    return s.replace("'","''").replace("\\","\\\\")
+
+def psql_copy_str(s):
+    '''Escape string for PostgreSQL COPY text format
+    '''
+    return s.replace("\\","\\\\").replace("\t","\\t").replace("\n","\\n").replace("\r","\\r")
+
+#
+# Value encoders. One encoder is compiled per column from its SQL type
+# so values are formatted without any per-value type checks.
+#
+def insert_text(v):
+    return "NULL" if v == None or v == "" else "'%s'" % psql_esc_str("%s" % v)
+
+def insert_number(v):
+    return "NULL" if v == None else "%s" % v
+
+def insert_date(v):
+    return "NULL" if v == None else "'%s'" % v
+
+def copy_text(v):
+    return "\\N" if v == None or v == "" else psql_copy_str("%s" % v)
+
+def copy_value(v):
+    return "\\N" if v == None else "%s" % v
+
+# integer columns: SAS numbers are doubles, so whole numbers are formatted
+# without the fraction (code columns are loaded as floats and only narrowed
+# once loaded, so fractional values never reach an integer column)
+def insert_integer(v):
+    return "NULL" if v == None else "%d" % v if v == int(v) else "%s" % v
+
+def copy_integer(v):
+    return "\\N" if v == None else "%d" % v if v == int(v) else "%s" % v
+
+def embed_text(v):
+    return None if v == "" else v
+
+def embed_value(v):
+    return v
+
+def embed_integer(v):
+    return v if v == None or v != int(v) else int(v)
+
+# None maps to the encoder used for all other SQL types
+INSERT_ENCODERS = {"TEXT":insert_text, "DATE":insert_date, "SMALLINT":insert_integer,
+                   "INTEGER":insert_integer, None:insert_number}
+COPY_ENCODERS = {"TEXT":copy_text, "SMALLINT":copy_integer, "INTEGER":copy_integer,
+                 None:copy_value}
+EMBED_ENCODERS = {"TEXT":embed_text, "SMALLINT":embed_integer, "INTEGER":embed_integer,
+                  None:embed_value}
+
+def compile_encoders(header, sql_types, encoders=INSERT_ENCODERS):
+    '''Compile value encoders for each column in header
+    '''
+    return [encoders.get(sql_types.get(var),encoders[None]) for var in header]
+
+def encode_columns(batches, encoders, stats):
+    '''Apply column encoders to each column batch
+    '''
+    for cols in batches:
+        with stats.timed("encode"):
+            cols = [map(enc,col) if enc is not embed_value else col
+                    for enc,col in zip(encoders,cols)]
+        yield cols
+
+def encode_rows(batches, encoders, stats):
+    '''Apply column encoders to each column batch, yielding formatted rows
+    (tuples of strings)
+    '''
+    for cols in encode_columns(batches, encoders, stats):
+        for row in itertools.izip(*cols):
+            yield row
+
+
+class CopyRowEncoder(object):
+    '''File-like wrapper around an encoded row iterator. Rows are joined into
+    COPY text format lines only as psycopg2's copy_expert reads them, so no
+    SQL text for the table is ever materialized.
+    '''
+    def __init__(self, rows, stats):
+        self.rows = iter(rows)
+        self.stats = stats
+        self.buf = ""
+        self.n = 0
+
+    def read(self, size=-1):
+        chunks, n = [self.buf], len(self.buf)
+        while size < 0 or n < size:
+            try:
+                line = "\t".join(next(self.rows)) + "\n"
+            except StopIteration:
+                break
+            if type(line) is unicode:
+                line = line.encode("utf-8")
+            chunks += [line]
+            n += len(line)
+            self.n += 1
+
+        data = "".join(chunks)
+        if size < 0:
+            size = len(data)
+        data, self.buf = data[:size], data[size:]
+        self.stats.count("bytes_written", len(data))
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class Loader(object):
+    '''Database loader base class. dbname is a PostgreSQL database name or
+    the path of an embedded database file.
+    '''
+    # several processes can load into the database at the same time
+    parallel = True
+
+    # column labels are stored as COMMENT ON column ...
+    native_comments = True
+
+    # SQL type translations for this database
+    type_map = {}
+
+    # maximum number of columns in a table or view (None if unlimited)
+    column_max = 1600
+
+    # schema holding the OAI tables
+    schema = "public"
+
+    def __init__(self, dbname, stats=None):
+        self.stats = stats or ImportStats(logging=False)
+        self.con = self.connect(dbname)
+
+    @classmethod
+    def map_types(cls, sql_types):
+
+        return {k:cls.type_map.get(v,v) for k,v in sql_types.items()}
+
+    def execute(self, sql):
+        '''Execute one or more SQL statements
+        '''
+        self.con.cursor().execute(sql)
+
+    def query(self, sql):
+        cur = self.con.cursor()
+        cur.execute(sql)
+        return cur.fetchall()
+
+    def tables(self):
+        '''Lower case names of all tables
+        '''
+        sql = "SELECT lower(table_name) FROM information_schema.tables"
+        sql += " WHERE table_schema='%s';" % self.schema
+        return [x[0] for x in self.query(sql)]
+
+    def drop_table(self, name):
+
+        self.execute("DROP TABLE IF EXISTS %s CASCADE;" % name)
+
+    def comment_columns(self, name, var_labels):
+        pass
+
+    def narrow_columns(self, name, code_types):
+        '''Change the columns of table name (code_types maps column -> 
+        SMALLINT/INTEGER) that only hold whole numbers in range to their 
+        integer type. Returns the narrowed column types.
+        '''
+        if not code_types:
+            return {}
+
+        cols = sorted(code_types)
+        counts = ["SUM(CASE WHEN %s THEN 1 ELSE 0 END)" % misfit_sql(var, code_types[var])
+                  for var in cols]
+        counts = self.query("SELECT %s FROM %s;" % (",".join(counts), name))[0]
+
+        types = {var:code_types[var] for var,n in zip(cols,counts) if not n}
+        if types:
+            self.alter_types(name, types)
+        return types
+
+    def alter_types(self, name, types):
+        '''Change column types (values are cast) in a single table rewrite
+        '''
+        clauses = ["ALTER COLUMN %s TYPE %s USING CAST(%s AS %s)" % (var,types[var],var,types[var])
+                   for var in sorted(types)]
+        self.execute("ALTER TABLE %s %s;" % (name, ", ".join(clauses)))
+
+    def bump_generation(self):
+
+        for sql in GENERATION_STATEMENTS:
+            self.execute(sql)
+        self.commit()
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+
+class PostgresLoader(Loader):
+    '''Load batches into PostgreSQL using COPY ... FROM STDIN
+    '''
+    def connect(self, dbname):
+
+        return psycopg2.connect(database=dbname, user='')
+
+    def load(self, name, header, batches, sql_types):
+        '''Stream column batches into table. Returns the number of rows
+        loaded.
+        '''
+        rows = encode_rows(batches, compile_encoders(header, sql_types, COPY_ENCODERS),
+                           self.stats)
+        sql = "COPY %s (%s) FROM STDIN" % (name,",".join(header))
+        stream = CopyRowEncoder(rows, self.stats)
+        self.con.cursor().copy_expert(sql, stream)
+        return stream.n
+
+
+class EmbeddedLoader(Loader):
+    '''Load batches into an embedded database file using parameterized
+    INSERTs, one executemany per batch. Statements are run on the connection
+    itself (a DuckDB cursor is a separate connection).
+    '''
+    parallel = False
+    native_comments = False
+
+    def comment_columns(self, name, var_labels):
+
+        self.execute(COLCOMMENTS_SCHEMA)
+
+        rows = []
+        for var in sorted(var_labels):
+            label = var_labels[var]
+            label = label.decode("utf-8",errors='ignore') if type(label) is str else label
+            rows += [(name.lower(),var,label)]
+
+        self.con.execute("DELETE FROM colcomments WHERE table_name = ?;", (name.lower(),))
+        self.con.executemany("INSERT INTO colcomments VALUES (?,?,?);", rows)
+
+    def query(self, sql):
+        return self.con.execute(sql).fetchall()
+
+    def insert(self, name, header, cols):
+
+        sql = "INSERT INTO %s (%s) VALUES (%s);" % (name,",".join(header),
+                                                    ",".join(["?"] * len(header)))
+        self.con.executemany(sql, zip(*cols))
+
+    def load(self, name, header, batches, sql_types):
+        '''Insert column batches into table. Returns the number of rows
+        loaded.
+        '''
+        encoders = compile_encoders(header, sql_types, EMBED_ENCODERS)
+
+        n = 0
+        for cols in encode_columns(batches, encoders, self.stats):
+            if cols and cols[0]:
+                self.insert(name, header, cols)
+                n += len(cols[0])
+        return n
+
+
+class DuckDBLoader(EmbeddedLoader):
+    '''Load batches into a DuckDB database file. Batches are inserted as
+    whole columns through a registered DataFrame when pandas is available.
+    '''
+    column_max = None
+    schema = "main"
+
+    def connect(self, dbname):
+
+        con = duckdb.connect(dbname)
+        con.begin()
+        return con
+
+    def execute(self, sql):
+        self.con.execute(sql)
+
+    def insert(self, name, header, cols):
+
+        if not pandas:
+            return EmbeddedLoader.insert(self, name, header, cols)
+
+        df = pandas.DataFrame(dict(zip(header,cols)), columns=header)
+        self.con.register("batch_df", df)
+        self.con.execute("INSERT INTO %s (%s) SELECT %s FROM batch_df;" %
+                         (name,",".join(header),",".join(header)))
+        self.con.unregister("batch_df")
+
+    def alter_types(self, name, types):
+
+        # DuckDB alters one column per statement
+        for var in sorted(types):
+            self.execute("ALTER TABLE %s ALTER COLUMN %s TYPE %s USING CAST(%s AS %s);" % 
+                         (name,var,types[var],var,types[var]))
+
+    def commit(self):
+
+        # DuckDB connections autocommit outside of explicit transactions
+        self.con.commit()
+        self.con.begin()
+
+
+class SQLiteLoader(EmbeddedLoader):
+    '''Load batches into a SQLite database file
+    '''
+    # SQLITE_MAX_COLUMN default
+    column_max = 2000
+
+    def connect(self, dbname):
+
+        return sqlite3.connect(dbname)
+
+    def execute(self, sql):
+        self.con.executescript(sql)
+
+    def drop_table(self, name):
+
+        self.execute("DROP TABLE IF EXISTS %s;" % name)
+
+    def narrow_columns(self, name, code_types):
+
+        # SQLite column types are only affinities and can't be altered
+        return {}
+
+    def tables(self):
+
+        return [x[0] for x in self.query("SELECT lower(name) FROM sqlite_master WHERE type='table';")]
+
+
+LOADERS = {"postgres":PostgresLoader, "duckdb":DuckDBLoader, "sqlite":SQLiteLoader}
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Import manifest shared by createdb.py and metadata.py. The manifest is a
+JSON file recording, for every imported data set group, the content hash
+of each source file, the inferred SQL schema and the number of rows loaded.
+Groups are only recorded once they are fully committed to the database, so
+an interrupted import resumes at the first incomplete group.
+'''
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 2
+
+def file_checksum(filename, blocksize=2**20):
+    '''SHA-1 hash of file contents
+    '''
+    h = hashlib.sha1()
+    with open(filename,"rb") as f:
+        for block in iter(lambda: f.read(blocksize), ""):
+            h.update(block)
+    return h.hexdigest()
+
+def file_checksums(inputdir, files):
+
+    return {x:file_checksum("%s%s" % (inputdir,x)) for x in files}
+
+def load_manifest(filename):
+    '''Load manifest file, or create an empty manifest if the file doesn't
+    exist or was written by an incompatible version.
+    '''
+    manifest = {"version":MANIFEST_VERSION, "groups":{}}
+    if not os.path.exists(filename):
+        return manifest
+
+    with open(filename,"rU") as f:
+        data = json.load(f)
+
+    if data.get("version") != MANIFEST_VERSION:
+        return manifest
+
+    return data
+
+def save_manifest(filename, manifest):
+    '''Atomically replace manifest file, so a crash never leaves a
+    partially written manifest behind.
+    '''
+    tmpfile = "%s.tmp" % filename
+    with open(tmpfile,"w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmpfile, filename)
+
+def is_current(manifest, name, checksums):
+    '''True if group was completely imported from identical source files
+    '''
+    entry = manifest["groups"].get(name)
+    return entry != None and entry["files"] == checksums
+
+def invalidate_group(filename, manifest, name):
+    '''Remove group from manifest before it's (re)imported
+    '''
+    if name in manifest["groups"]:
+        del manifest["groups"][name]
+        save_manifest(filename, manifest)
+
+def record_group(filename, manifest, name, checksums, schema, rows):
+    '''Record a completely imported group
+    '''
+    manifest["groups"][name] = {"files":checksums, "schema":schema, "rows":rows}
+    save_manifest(filename, manifest)
@@ -1,17 +1,62 @@
 import argparse
+import imp
 import os
 import re
 import sys
 import bz2
 import operator
+import itertools
+import multiprocessing
+import tempfile
+import subprocess
+import cPickle as pickle
 from optparse import Values
+from multiprocessing.pool import ThreadPool
+
+from instrument import ImportStats
+from loaders import LOADERS, GENERATION_SQL
+from manifest import load_manifest, file_checksum, is_current, \
+    invalidate_group, record_group
 
 PDF2TEXT = "/usr/local/bin/pdftotext"
 TMP_ROOT = "/tmp/"
 
+# concurrent pdftotext processes used by pdfs2text
+PDF2TEXT_JOBS = 4
+
+METADATA_TABLES = ["varcategories","vardefs","categorydefs"]
+
+# parsed metadata cache format, defined by its reader datasets/metacache.py
+# (loaded by path, the datasets package itself needs numpy and a database 
+# driver)
+METACACHE = imp.load_source("metacache", os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "..", "datasets", "metacache.py"))
+CACHE_VERSION = METACACHE.CACHE_VERSION
+
+# import pipeline timing
+STATS = ImportStats()
+
+# variable guide pages are separated by lines of underscores
+PAGE_BREAK = re.compile("[_]{2,}")
+READ_SIZE = 2**20
+
+# compiled once per process, not once per line
+HEADER_FOOTER = re.compile("Page \d+ of \d+|Release Version|Variable Guide")
+INDENT = re.compile("\s+")
+SPACES = re.compile("\s{2,}")
+CATEGORY = re.compile("Category\s+SubCategory")
+FIELDS = {}
+FIELDS["label"] = re.compile("Label:(.*)")
+FIELDS["collection"] = re.compile("Data Collection Form:(.+)")
+FIELDS["dataset"] = re.compile("SAS Dataset:(.+)")
+FIELDS["comments"] = re.compile("Release Comments:(.+)")
+FIELDS["category"] = CATEGORY
+LABEL = re.compile("^(.*):")
+COUNT_SUFFIX = re.compile("\d*[,]*\d+$")
+
 metadata_schema = '''
 CREATE TABLE categorydefs (
-    id SERIAL,
+    id INTEGER NOT NULL,
     type INTEGER NOT NULL,
     name TEXT NOT NULL,
     PRIMARY KEY(id) );
@@ -32,20 +77,6 @@ CREATE TABLE vardefs (
     PRIMARY KEY(var_id) );
 '''    
 
-def longest_common_substring(s1, s2):
-    m = [[0] * (1 + len(s2)) for i in xrange(1 + len(s1))]
-    longest, x_longest = 0, 0
-    for x in xrange(1, 1 + len(s1)):
-        for y in xrange(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
-                    x_longest = x
-            else:
-                m[x][y] = 0
-    return s1[x_longest - longest: x_longest]
-
 def psql_esc_str(s):
     return s.replace("'","''").replace("\\","\\\\")
 
@@ -54,31 +85,62 @@ def norm_col_name(s):
     '''
     return re.sub("^([V]+)(\d\d)",r'\1',s).lower()
 
-def pdf2text(data,layout=True,tmpdir="/tmp"):
-    ''' Convert PDF document to plain text file using external pdftotext
-    command line utility. 
+def pdf2text(data,layout=True,tmpdir=TMP_ROOT,stdin=True):
+    ''' Convert PDF document to plain text using external pdftotext
+    command line utility. The PDF is piped to pdftotext and the text read
+    from its stdout. Versions of pdftotext that can't read from stdin 
+    (stdin=False) are passed a uniquely named temporary file instead. 
     
     '''
-    pdffile = "%s/contents.pdf" % (tmpdir)
-    txtfile = "%s/contents.txt" % (tmpdir)
+    if stdin:
+        return pdftotext_run("-", data, layout)
     
-    # dump PDF to a temporary file
-    with open(pdffile,"wb") as tmp:
+    with tempfile.NamedTemporaryFile(suffix=".pdf",dir=tmpdir) as tmp:
         tmp.write(data)
-    
-    # convert it to plain text
-    cmd = "%s -layout %s %s" % (PDF2TEXT, pdffile, txtfile)
-    os.system(cmd)
+        tmp.flush()
+        return pdftotext_run(tmp.name, None, layout)
 
-    # read in text file contents
-    with open(txtfile) as f:
-        txt = "".join(f.readlines())
-    
-    # clean up
-    os.remove(pdffile)
-    os.remove(txtfile)
+def pdftotext_run(pdffile,data=None,layout=True):
+    '''Run pdftotext on pdffile ("-" reads data from stdin), returning the
+    text written to stdout
+    '''
+    cmd = [PDF2TEXT] + (["-layout"] if layout else []) + [pdffile, "-"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                            stderr=subprocess.PIPE)
+    txt, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise IOError("%s failed on %s: %s" % (PDF2TEXT, pdffile, err.strip()))
     
     return txt
+
+def pdfs2text(filenames,layout=True,jobs=PDF2TEXT_JOBS):
+    '''Convert PDF files to plain text, running at most jobs pdftotext
+    processes at once. Yields (filename, text) pairs in input order.
+    '''
+    pool = ThreadPool(jobs)
+    try:
+        convert = lambda pdffile:pdftotext_run(pdffile, None, layout)
+        for item in itertools.izip(filenames, pool.imap(convert, filenames)):
+            yield item
+    finally:
+        pool.terminate()
+
+def pdfdir2text(inputdir,outputdir=None,layout=True,jobs=PDF2TEXT_JOBS):
+    '''Convert every PDF in inputdir to a .txt file of the same name in 
+    outputdir (default inputdir). Returns the names of the text files.
+    '''
+    outputdir = outputdir or inputdir
+    filenames = sorted([os.path.join(inputdir,x) for x in os.listdir(inputdir) 
+                        if x.lower().endswith(".pdf")])
+    
+    txtfiles = []
+    for pdffile,txt in pdfs2text(filenames, layout, jobs):
+        name = os.path.splitext(os.path.basename(pdffile))[0]
+        txtfiles += [os.path.join(outputdir,"%s.txt" % name)]
+        with open(txtfiles[-1],"w") as f:
+            f.write(txt)
+    
+    return txtfiles
                    
 def table_parser(rows):
     ''' Parse out category and variable types tables.
@@ -118,8 +180,8 @@ def table_parser(rows):
     if len(dtable) == 1:
         return table_data
    
-    header = re.split("\s{2,}",dtable.pop(0))
-    header = [x for x in re.split("\s{2,}",line) if x]
+    header = SPACES.split(dtable.pop(0))
+    header = [x for x in SPACES.split(line) if x]
     
     if set(["Min","Max","Std Dev"]).intersection(header):
         table_data["type"] = "continuous"
@@ -129,7 +191,7 @@ def table_parser(rows):
     ftable = []
     for line in dtable:
         line = line.replace("''  :","'':")
-        values = [x for x in re.split("\s{2,}",line) if x]
+        values = [x for x in SPACES.split(line) if x]
         
         # HACK -- not enough spaces to correctly delimit 
         # manually split first column
@@ -140,7 +202,7 @@ def table_parser(rows):
             if sum([1 for x in terms if x in values[1]]):
                 values = ["%s %s" %(values[0], values[1])] + values[2:]
             else:
-                m = re.search("\d*[,]*\d+$",values[0])
+                m = COUNT_SUFFIX.search(values[0])
                 if m:
                     col = m.group(0)
                     values[0] = values[0].replace(col,"").strip()
@@ -155,7 +217,7 @@ def table_parser(rows):
             ftable += [values]
         
     table_data["type"] = "nominal"
-    labels = [re.match("^(.*):",x[0]) for x in ftable]
+    labels = [LABEL.match(x[0]) for x in ftable]
     
     # class labels are *not* numbered
     if len(labels) == labels.count(None):
@@ -182,17 +244,17 @@ def table_parser(rows):
     return table_data
 
 def is_header_footer(s):
-    return re.search("Page \d+ of \d+",s) or re.search("Release Version",s) or \
-        re.search("Variable Guide",s)
+    return HEADER_FOOTER.search(s)
 
 
 def sql_populate_metadata(metadata):
-    '''Generate three SQL tables using hand-coded schema from oai.sql 
+    '''Generate three SQL tables using hand-coded schema from oai.sql. 
+    Returns the SQL and the number of rows in each table.
     '''
     CATEGORY = 1
     SUBCATEGORY = 2
     
-    catdefs_schema = "INSERT INTO categorydefs (type, name) VALUES"
+    catdefs_schema = "INSERT INTO categorydefs (id, type, name) VALUES"
     varcats_schema = "INSERT INTO varcategories (var_id, cat_id) VALUES"
     vardefs_schema = "INSERT INTO vardefs (var_id, type, labeln, labelset, "
     vardefs_schema += "dataset, collect_form, comment) VALUES"
@@ -214,11 +276,11 @@ def sql_populate_metadata(metadata):
     category_ids = {CATEGORY:{},SUBCATEGORY:{}}
     for name in sorted(categorydefs[CATEGORY].keys()):
         category_ids[CATEGORY][name] = idx
-        categories += ["\t(%s, '%s')" % (CATEGORY, psql_esc_str(name))]
+        categories += ["\t(%s, %s, '%s')" % (idx, CATEGORY, psql_esc_str(name))]
         idx += 1
     for name in sorted(categorydefs[SUBCATEGORY].keys()):
         category_ids[SUBCATEGORY][name] = idx
-        categories += ["\t(%s, '%s')" % (SUBCATEGORY, psql_esc_str(name))]
+        categories += ["\t(%s, %s, '%s')" % (idx, SUBCATEGORY, psql_esc_str(name))]
         idx += 1
     #
     # 2. Variable to category mappings
@@ -251,15 +313,92 @@ def sql_populate_metadata(metadata):
         
     vardefs = map(lambda x:"\t('%s', '%s', %s, %s, %s, %s, %s)" % x, vardefs)
     
-    print metadata_schema 
-    print ("%s\n%s;" % (catdefs_schema, ",\n".join(categories))).lower()
-    print
-    print ("%s\n%s;" % (varcats_schema, ",\n".join(varcats))).lower()
-    print
-    print ("%s\n%s;" % (vardefs_schema, ",\n".join(vardefs))).lower()
+    sql = [metadata_schema]
+    sql += [("%s\n%s;\n" % (catdefs_schema, ",\n".join(categories))).lower()]
+    sql += [("%s\n%s;\n" % (varcats_schema, ",\n".join(varcats))).lower()]
+    sql += [("%s\n%s;" % (vardefs_schema, ",\n".join(vardefs))).lower()]
     
+    rows = {"categorydefs":len(categories), "varcategories":len(varcats), 
+            "vardefs":len(vardefs)}
+    
+    return "\n".join(sql), rows
+    
+
+def iter_pages(datfile, size=READ_SIZE):
+    '''Yield the pages of the variable guide text, reading (and, for bz2
+    files, decompressing) size bytes at a time.
+    '''
+    buf = ""
+    while True:
+        with STATS.timed("unzip"):
+            data = datfile.read(size)
+        if not data:
+            break
+        buf += data
+        
+        # a trailing run of underscores may continue in the next block
+        n = len(buf.rstrip("_"))
+        pages = PAGE_BREAK.split(buf[:n])
+        buf = pages.pop() + buf[n:]
+        for page in pages:
+            yield page
+    
+    for page in PAGE_BREAK.split(buf):
+        yield page
 
-def load_metadata(filename):
+def parse_page(page):
+    '''Parse one variable guide page. Returns the variable's record, or
+    None for pages without any metadata.
+    '''
+    # create page item
+    # remove garbage lines (i.e., page numbers and footers)
+    lines = page.split("\n")    
+    lines = [x for x in lines if x.strip() and not is_header_footer(x)]
+    
+    record = {"id":None, "label":None, "dataset":None, "comments": None}
+    record["collection"] = None
+    record["category"] = []
+    record["subcategory"] = []
+    
+    for i,line in enumerate(lines):
+        
+        if INDENT.match(line[0])  and not record["id"]:
+            continue
+        
+        if not record["id"]:
+            record["id"] = line.strip()
+            continue
+        
+        if record["label"] and not record["collection"] and \
+        INDENT.match(line[0]):
+            record["label"] += line
+            
+        for field in FIELDS:
+            m = FIELDS[field].search(line)
+            if m and field != "category":
+                record[field] = m.group(1).strip()
+    
+        # extract categories and subcategories
+        m = CATEGORY.search(line)
+        if m:
+            
+            table_data = table_parser(lines[i:])
+            record.update(table_data)
+             
+            break
+   
+    # Fix labels for complete records. Ignore empty records.
+    # Categories can be duplicated, so ensure labels are unique.
+    if not sum([1 if v else 0 for v in record.values()]):
+        return None
+    
+    record["label"] = SPACES.sub(" ",record["label"])
+    record["comments"] = SPACES.sub(" ",record["comments"])
+    record["category"] = {x:1 for x in record["category"]}.keys()
+    record["subcategory"] = {x:1 for x in record["subcategory"]}.keys()
+    return record
+
+def load_metadata(filename, jobs=None):
     '''Parse data out of variable description PDF (VG_Variable.pdf) provided 
     by the OAI. File is converted to text using:
     
@@ -268,6 +407,8 @@ def load_metadata(filename):
     This file gives us category, subcategory, and data set information, which
     I can't seem to locate as independant data sets on the OAI web site.
     
+    The text is streamed page by page and pages are parsed by a pool of
+    jobs processes (default: one per CPU; 1 parses in this process).
     '''
     datdict = {}
     
@@ -276,68 +417,21 @@ def load_metadata(filename):
         datfile = bz2.BZ2File(filename,"rb")
     else:
         datfile = open(filename,"rU")
-        
-    with datfile:
-        data = datfile.readlines()
     
-    data = "".join(data)
-    pages = re.split("[_]{2,}",data)
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    imap = pool.imap if pool else itertools.imap
     
-    regex = {}
-    regex["label"] = re.compile("Label:(.*)")
-    regex["collection"] = re.compile("Data Collection Form:(.+)")
-    regex["dataset"] = re.compile("SAS Dataset:(.+)")
-    regex["comments"] = re.compile("Release Comments:(.+)")
-    regex["category"] = re.compile("Category\s+SubCategory")
+    # results arrive in page order, so later pages win as before
+    try:
+        with datfile:
+            for record in imap(parse_page, iter_pages(datfile)):
+                if record:
+                    datdict[record["id"]] = record
+    finally:
+        if pool:
+            pool.terminate()
     
-    for item in pages:
-        
-        # create page item
-        # remove garbage lines (i.e., page numbers and footers)
-        lines = item.split("\n")    
-        lines = [x for x in lines if x.strip() and not is_header_footer(x)]
-        
-        record = {"id":None, "label":None, "dataset":None, "comments": None}
-        record["collection"] = None
-        record["category"] = []
-        record["subcategory"] = []
-        
-        for i,line in enumerate(lines):
-            
-            if re.match("\s+",line[0])  and not record["id"]:
-                continue
-            
-            if not record["id"]:
-                record["id"] = line.strip()
-                continue
-            
-            if record["label"] and not record["collection"] and \
-            re.match("\s+",line[0]):
-                record["label"] += line
-                
-            for field in regex:
-                m = regex[field].search(line)
-                if m and field != "category":
-                    record[field] = m.group(1).strip()
-        
-            # extract categories and subcategories
-            m = regex["category"].search(line)
-            if m:
-                
-                table_data = table_parser(lines[i:])
-                record.update(table_data)
-                 
-                break
-       
-        # Fix labels for complete records. Ignore empty records.
-        # Categories can be duplicated, so ensure labels are unique.
-        if sum([1 if v else 0 for v in record.values()]):
-            record["label"] = re.sub("\s{2,}"," ",record["label"])
-            record["comments"] = re.sub("\s{2,}"," ",record["comments"])
-            record["category"] = {x:1 for x in record["category"]}.keys()
-            record["subcategory"] = {x:1 for x in record["subcategory"]}.keys()
-            datdict[record["id"]] = record
-
     return datdict
 
 def collapse_metadata(metadata):
@@ -390,22 +484,141 @@ def collapse_metadata(metadata):
   
     return md
     
-def main(args):
+def cache_header(filename):
+    '''Header of a parsed metadata cache file, or None if there is no
+    cache file or it was written by an incompatible version
+    '''
+    if not os.path.exists(filename):
+        return None
+    
+    with open(filename,"rb") as f:
+        try:
+            header = pickle.load(f)
+            return header if header.get("version") == CACHE_VERSION else None
+        except Exception:
+            return None
+
+def load_cache(filename, checksum):
+    '''Collapsed metadata from cache file, or None if the cache wasn't 
+    built from a variable guide with this checksum
+    '''
+    header = cache_header(filename)
+    if not header or header["checksum"] != checksum:
+        return None
+    
+    with open(filename,"rb") as f:
+        pickle.load(f)
+        return pickle.load(f)
+
+def save_cache(filename, checksum, metadata, source):
+    '''Write collapsed metadata, preceded by a header with the cache version
+    and the checksum of the variable guide it was parsed from. The file is
+    replaced atomically.
+    '''
+    header = {"version":CACHE_VERSION, "checksum":checksum, "source":source}
+    
+    tmpfile = "%s.tmp" % filename
+    with open(tmpfile,"wb") as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(metadata, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfile, filename)
+
+def import_metadata(args):
+    
+    source = os.path.basename(args.infile)
+    checksum = file_checksum(args.infile)
+    checksums = {source:checksum}
+    
+    cached = args.cache and (cache_header(args.cache) or {}).get("checksum") == checksum
+    
+    # incremental import: skip if the variable guide is unchanged
+    manifest = load_manifest(args.manifest) if args.manifest else None
+    if manifest != None:
+        if is_current(manifest, "metadata", checksums) and (cached or not args.cache):
+            STATS.log(" (skipping) metadata unchanged")
+            return
     
     #
-    # 1. Category/sub-category information 
+    # 1. Category/sub-category information (parsed, or from the cache)
     #
-    metatdata = load_metadata(args.infile)
-    norm_metadata = collapse_metadata(metatdata)
-    sql_populate_metadata(norm_metadata)
+    norm_metadata = load_cache(args.cache, checksum) if cached else None
+    if norm_metadata != None:
+        STATS.log(" (cached) metadata %s" % args.cache)
+    else:
+        STATS.count("bytes_read", os.path.getsize(args.infile))
+        metatdata = load_metadata(args.infile, args.jobs)
+        with STATS.timed("collapse"):
+            norm_metadata = collapse_metadata(metatdata)
+        if args.cache:
+            save_cache(args.cache, checksum, norm_metadata, source)
+    
+    with STATS.timed("encode"):
+        sql, rows = sql_populate_metadata(norm_metadata)
+    
+    STATS.count("rows", sum(rows.values()))
+    STATS.count("bytes_written", len(sql))
+    
+    if not args.dbname:
+        with STATS.timed("emit"):
+            print sql
+            print GENERATION_SQL
+        return
+    
+    # load directly into the database (or embedded database file)
+    with STATS.timed("emit"):
+        db = LOADERS[args.backend](args.dbname, STATS)
+        if manifest != None:
+            invalidate_group(args.manifest, manifest, "metadata")
+            for name in METADATA_TABLES:
+                db.drop_table(name)
+        db.execute(sql)
+        db.commit()
+        db.bump_generation()
+        db.close()
+    
+    if manifest != None:
+        record_group(args.manifest, manifest, "metadata", checksums, 
+                     METADATA_TABLES, rows)
+
+def main(args):
+    
+    STATS.logging = args.logging
+    
+    # parse time is whatever isn't read, collapse, encode or emit time
+    infile = os.path.basename(args.infile)
+    with STATS.track("metadata", infile, residual="parse") as rec:
+        import_metadata(args)
+    STATS.log_record(rec)
+    
+    if args.report:
+        STATS.write(args.report)
          
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser()
     parser.add_argument("-i","--infile", type=str, help="metadata input file",
                         default="../../data/VG_Variable_tables.bz2")
+    parser.add_argument("-d","--dbname", type=str, 
+                        help="load directly into this database, or database file for embedded backends (no SQL output)")
+    parser.add_argument("-b","--backend", type=str, default="postgres", 
+                        choices=sorted(LOADERS.keys()), help="database backend")
+    parser.add_argument("-j","--jobs", type=int, 
+                        help="metadata parser processes (default: one per CPU)")
+    parser.add_argument("--manifest", type=str, 
+                        help="import manifest file; only reload if changed (requires --dbname)")
+    parser.add_argument("-c","--cache", type=str, 
+                        help="parsed metadata cache file; only reparse if the input changed")
+    parser.add_argument("-l","--no-logging", action='store_false', dest="logging",
+                        help="disable logging")
+    parser.add_argument("--report", type=str, 
+                        help="write JSON timing report to this file")
            
     args = parser.parse_args()
+    
+    # argument error, exit
+    if args.manifest and not args.dbname:
+        parser.print_help()
+        sys.exit()
 
     main(args)
 
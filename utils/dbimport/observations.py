@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Long-format observation store populated by createdb.py --observations.
+Every non-missing value of a subject/visit data set becomes one row of
+
+  observations(dataset, subject, vid, row_num, var_id, value_num, value_code)
+
+dataset is the source table and row_num the row's position in its source
+file, so values of data sets with several rows per subject and visit (e.g.,
+one per knee side and read project in kXR_*/kMRI_*) can be told apart and
+joined back together. Numeric values are stored in value_num, text and 
+dates in value_code. The (var_id, subject, vid) index lets any set of 
+variables be fetched with a single index range scan (indexdb.py also 
+CLUSTERs the table on it).
+'''
+import tempfile
+import cPickle as pickle
+
+OBSERVATIONS_TABLE = "observations"
+OBSERVATIONS_HEADER = ["dataset","subject","vid","row_num","var_id","value_num",
+                       "value_code"]
+OBSERVATIONS_TYPES = {"dataset":"TEXT", "subject":"TEXT", "vid":"INTEGER", 
+                      "row_num":"INTEGER", "var_id":"TEXT", 
+                      "value_num":"DOUBLE PRECISION", "value_code":"TEXT"}
+OBSERVATIONS_INDEX = ["var_id","subject","vid"]
+
+OBSERVATIONS_SCHEMA = """CREATE TABLE IF NOT EXISTS observations (
+\tdataset VARCHAR(64) NOT NULL,
+\tsubject TEXT NOT NULL,
+\tvid INTEGER NOT NULL,
+\trow_num INTEGER NOT NULL,
+\tvar_id VARCHAR(20) NOT NULL,
+\tvalue_num DOUBLE PRECISION,
+\tvalue_code TEXT);
+"""
+
+# key columns of the source tables (not observations)
+KEY_COLUMNS = ["id","vid","version"]
+
+# spooled observations kept in memory before overflowing to disk
+SPOOL_MAX = 2**26
+
+def index_sql():
+
+    name = "%s_%s_idx" % (OBSERVATIONS_TABLE,"_".join(OBSERVATIONS_INDEX))
+    return "CREATE INDEX IF NOT EXISTS %s ON %s (%s);" % (name, OBSERVATIONS_TABLE,
+                                                          ",".join(OBSERVATIONS_INDEX))
+
+def dataset_name(grp):
+    '''Value of the dataset column for a data set group (its table name)
+    '''
+    return grp.lower()
+
+def clear_sql(grp):
+    '''Remove the observations of a (re)imported data set
+    '''
+    return "DELETE FROM %s WHERE dataset = '%s';" % (OBSERVATIONS_TABLE, dataset_name(grp))
+
+def long_batch(dataset, header, cols, sql_types, offset=0):
+    '''Convert one column batch of a wide table to observation columns.
+    offset is the source file row number of the batch's first row.
+    '''
+    index = {var:j for j,var in enumerate(header)}
+    ids, vids = cols[index["id"]], cols[index["vid"]]
+
+    subjects, visits, row_nums, var_ids, nums, codes = [], [], [], [], [], []
+    for var,col in zip(header,cols):
+        if var in KEY_COLUMNS:
+            continue
+
+        rows = [i for i,v in enumerate(col) if v != None and v != ""]
+        if not rows:
+            continue
+
+        subjects += [ids[i] for i in rows]
+        visits += [vids[i] for i in rows]
+        row_nums += [offset + i for i in rows]
+        var_ids += [var] * len(rows)
+
+        # text and dates are stored as codes
+        if sql_types.get(var) in ["TEXT","DATE"]:
+            nums += [None] * len(rows)
+            codes += ["%s" % col[i] for i in rows]
+        else:
+            nums += [col[i] for i in rows]
+            codes += [None] * len(rows)
+
+    return [[dataset] * len(subjects), subjects, visits, row_nums, var_ids, nums, codes]
+
+
+class ObservationSpool(object):
+    '''Collects the observations of the column batches of one source file
+    of data set grp passing through tee() in a temp file (in memory up to 
+    SPOOL_MAX bytes), so they can be loaded once the source table itself is
+    loaded.
+    '''
+    def __init__(self, grp, tmpdir=None):
+        self.dataset = dataset_name(grp)
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX, dir=tmpdir)
+        self.n = 0
+
+    def tee(self, batches, sql_types):
+        header = next(batches)
+        yield header
+
+        # single file groups have no visit column
+        if "id" not in header or "vid" not in header:
+            for cols in batches:
+                yield cols
+            return
+
+        offset = 0
+        for cols in batches:
+            pickle.dump(long_batch(self.dataset, header, cols, sql_types, offset), 
+                        self.spool, pickle.HIGHEST_PROTOCOL)
+            offset += len(cols[0]) if cols else 0
+            self.n += 1
+            yield cols
+
+    def batches(self):
+        '''Header and observation column batches
+        '''
+        yield OBSERVATIONS_HEADER
+
+        self.spool.seek(0)
+        for i in xrange(self.n):
+            yield pickle.load(self.spool)
+        self.spool.close()
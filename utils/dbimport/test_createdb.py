@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Tests of the createdb.py import drivers, run on small zip archives read by
+a stub SAS reader:
+
+  python -m unittest test_createdb
+'''
+import os
+import re
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+import cStringIO
+from optparse import Values
+
+import createdb
+from loaders import Loader, SQLiteLoader
+from manifest import load_manifest, save_manifest, file_checksums, record_group
+
+class CSVReader(createdb.SASReader):
+    '''Reads archive members holding "id,value" lines instead of SAS files
+    '''
+    def open(self):
+        rows = [line.split(",") for line in self.zf.read(self.member).splitlines()]
+        rows = [[sid, float(value)] for sid,value in rows]
+        self.columns = [createdb.SASColumn("ID","","Subject id","string",8),
+                        createdb.SASColumn("V00VALUE","","Value","number",8)]
+        self.stream = createdb.row_batches(rows, self.batch_rows)
+
+    def close(self):
+        pass
+
+# registered at import, so forked pool workers have it too
+createdb.READERS["csv"] = CSVReader
+
+class IncrementalImportTest(unittest.TestCase):
+
+    GROUPS = ["JointSx", "MedHist"]
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.inputdir = os.path.join(self.tmpdir, "input/")
+        os.mkdir(self.inputdir)
+
+        for grp in self.GROUPS:
+            for visit in ["00","01"]:
+                self.write_archive(grp, visit, "9000001,1\n9000002,2\n")
+
+        # both groups were imported, then MedHist's files changed
+        self.manifest = os.path.join(self.tmpdir, "manifest.json")
+        filelist = createdb.group_by_filename(sorted(os.listdir(self.inputdir)))
+        manifest = load_manifest(self.manifest)
+        for grp in self.GROUPS:
+            checksums = file_checksums(self.inputdir, filelist[grp])
+            record_group(self.manifest, manifest, grp, checksums, {}, 4)
+        save_manifest(self.manifest, manifest)
+
+        self.write_archive("MedHist", "01", "9000001,1\n9000002,3\n")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def write_archive(self, grp, visit, data):
+
+        filename = os.path.join(self.inputdir, "%s%s_SAS.zip" % (grp,visit))
+        with zipfile.ZipFile(filename, "w") as zf:
+            zf.writestr("%s%s.sas7bdat" % (grp.lower(),visit), data)
+
+    def imported_groups(self, jobs):
+        '''Run an incremental import (SQL output) on a copy of the manifest,
+        returning the data set tables created
+        '''
+        manifest = os.path.join(self.tmpdir, "manifest-%d.json" % jobs)
+        shutil.copy(self.manifest, manifest)
+
+        args = Values({"inputdir":self.inputdir, "dbname":None, "backend":"postgres",
+                       "manifest":manifest, "reader":"csv", "tsdir":None,
+                       "observations":False, "jobs":jobs, "logging":False,
+                       "report":None})
+
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            createdb.main(args)
+            sql = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        tables = re.findall("CREATE TABLE (?:IF NOT EXISTS )?\"?(\w+)", sql)
+        return [x for x in tables if x.lower() in [g.lower() for g in self.GROUPS]]
+
+    def test_changed_groups(self):
+
+        serial = self.imported_groups(1)
+        self.assertEqual([x.lower() for x in serial], ["medhist"])
+        self.assertEqual(self.imported_groups(2), serial)
+
+class NarrowingLoader(SQLiteLoader):
+    '''SQLite loader checking code columns like the other backends, but 
+    recording the column types instead of altering them
+    '''
+    narrow_columns = Loader.narrow_columns
+
+    def alter_types(self, name, types):
+        self.altered = types
+
+class NarrowCodesTest(unittest.TestCase):
+
+    def test_whole_column(self):
+
+        db = NarrowingLoader(":memory:")
+        db.execute("CREATE TABLE medhist (id TEXT, v00a REAL, v00b REAL, v00c REAL);")
+        rows = [("'9000%03d'" % i, 1, 2, 3) for i in range(1500)]
+        rows += [("'9001500'", 2, 2.5, 40000), ("'9001501'", None, None, None)]
+        db.execute("INSERT INTO medhist VALUES %s;" % 
+                   ",".join(["(%s,%s,%s,%s)" % r for r in rows]).replace("None","NULL"))
+
+        sql_types = {"id":"TEXT", "v00a":"REAL", "v00b":"REAL", "v00c":"REAL"}
+        codes = {"v00a":"SMALLINT", "v00b":"SMALLINT", "v00c":"SMALLINT"}
+        sql_types = createdb.narrow_codes("medhist", sql_types, codes, db)
+
+        self.assertEqual(db.altered, {"v00a":"SMALLINT"})
+        self.assertEqual(sql_types, {"id":"TEXT", "v00a":"SMALLINT", 
+                                     "v00b":"REAL", "v00c":"REAL"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Tests of metadata.py: the parsed metadata cache header, and the pdftotext
+wrappers run against a stub pdftotext script:
+
+  python -m unittest test_metadata
+'''
+import os
+import cPickle as pickle
+import stat
+import shutil
+import tempfile
+import unittest
+
+import metadata
+
+# prints its arguments, then its input (stdin for "-") upper cased; input
+# files named *bad* fail like a damaged PDF
+PDF2TEXT_STUB = '''#!/bin/sh
+for last; do :; done
+eval in=\\${$(($#-1))}
+echo "$@"
+case "$in" in
+    -) tr a-z A-Z ;;
+    *bad*) echo "broken PDF" >&2; exit 1 ;;
+    *) tr a-z A-Z < "$in" ;;
+esac
+'''
+
+class PDF2TextTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        stub = os.path.join(self.tmpdir, "pdftotext")
+        with open(stub, "w") as f:
+            f.write(PDF2TEXT_STUB)
+        os.chmod(stub, stat.S_IRWXU)
+
+        self.pdf2text = metadata.PDF2TEXT
+        metadata.PDF2TEXT = stub
+
+    def tearDown(self):
+
+        metadata.PDF2TEXT = self.pdf2text
+        shutil.rmtree(self.tmpdir)
+
+    def test_stdin(self):
+
+        txt = metadata.pdf2text("variable guide", tmpdir=self.tmpdir)
+        self.assertEqual(txt, "-layout - -\nVARIABLE GUIDE")
+
+        txt = metadata.pdf2text("variable guide", layout=False, tmpdir=self.tmpdir)
+        self.assertEqual(txt, "- -\nVARIABLE GUIDE")
+
+    def test_tempfile(self):
+
+        txt = metadata.pdf2text("variable guide", tmpdir=self.tmpdir, stdin=False)
+        args, txt = txt.split("\n", 1)
+        args = args.split()
+
+        self.assertEqual(txt, "VARIABLE GUIDE")
+        self.assertEqual(args[0], "-layout")
+        self.assertEqual(os.path.dirname(args[1]), self.tmpdir)
+        self.assertTrue(args[1].endswith(".pdf"))
+
+        # the temp file is removed once converted
+        self.assertFalse(os.path.exists(args[1]))
+
+    def test_failure(self):
+
+        pdffile = os.path.join(self.tmpdir, "bad.pdf")
+        with open(pdffile, "w") as f:
+            f.write("variable guide")
+
+        with self.assertRaises(IOError) as cm:
+            metadata.pdftotext_run(pdffile)
+        self.assertIn("broken PDF", str(cm.exception))
+        self.assertIn(pdffile, str(cm.exception))
+
+class CacheHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tmpdir, "metadata.pkl")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def write_header(self, header):
+
+        with open(self.cachefile, "wb") as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+
+    def test_current(self):
+
+        self.write_header({"version":metadata.CACHE_VERSION, "checksum":"x"})
+        self.assertEqual(metadata.cache_header(self.cachefile)["checksum"], "x")
+
+    def test_rebuilt(self):
+
+        self.assertIsNone(metadata.cache_header(self.cachefile))
+
+        # older versions and formats, or a damaged file, rebuild the cache
+        for header in [{"version":metadata.CACHE_VERSION - 1}, ["vardefs"], None]:
+            self.write_header(header)
+            self.assertIsNone(metadata.cache_header(self.cachefile))
+
+        with open(self.cachefile, "wb") as f:
+            f.write("not a pickle")
+        self.assertIsNone(metadata.cache_header(self.cachefile))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Chunked, compressed columnar store for time series data sets (AccelData)
+that are too large to load into the database. A store is a directory of
+chunk files (NumPy .npz, one compressed array per column) plus an index:
+
+  index.json      columns, chunk file names and, for every subject, the
+                  (chunk, start, stop) row segments holding its data
+  chunk-NNNNN.npz rows sorted by subject within the chunk
+
+Rows are written in chunks of at most chunk_rows, so memory use is bounded
+regardless of data set size. Stores are read by datasets/timeseries.py.
+'''
+import os
+import json
+import shutil
+import numpy as np
+
+STORE_VERSION = 1
+CHUNK_ROWS = 2**20
+
+def column_kind(column):
+    '''Storage kind of a SASColumn: number, date or string
+    '''
+    if column.type == "string":
+        return "string"
+    if column.format and "MMDDYY" in column.format:
+        return "date"
+    return "number"
+
+def column_array(col, kind):
+    '''Convert a column batch to a typed array. Missing numbers are NaN,
+    missing dates NaT and missing strings empty.
+    '''
+    if kind == "number":
+        if col.dtype.kind == "f":
+            return col.astype(np.float64)
+        col = col.copy()
+        col[np.equal(col,None)] = np.nan
+        return col.astype(np.float64)
+
+    if kind == "date":
+        return col.astype("M8[D]")
+
+    return np.array([u"" if v is None else unicode(v) for v in col], dtype=unicode)
+
+
+class TimeSeriesWriter(object):
+    '''Append column batches to a new store at path. The store is built in a
+    temporary directory and moved into place by close(), replacing any
+    previous store, so readers never see a partially written store.
+    '''
+    def __init__(self, path, names, kinds, key="id", chunk_rows=CHUNK_ROWS):
+        self.path = path.rstrip("/")
+        self.tmpdir = "%s.tmp" % self.path
+        self.names = names
+        self.kinds = kinds
+        self.key = names.index(key)
+        self.chunk_rows = chunk_rows
+
+        self.buf, self.n = [], 0
+        self.chunks, self.subjects, self.rows = [], {}, 0
+
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        os.makedirs(self.tmpdir)
+
+    def append(self, cols):
+        cols = [column_array(col,kind) for col,kind in zip(cols,self.kinds)]
+        self.buf += [cols]
+        self.n += len(cols[0])
+        if self.n >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        '''Write buffered rows as a chunk, sorted by subject (stable, so
+        each subject's rows keep their original order)
+        '''
+        if not self.n:
+            return
+
+        cols = [np.concatenate(x) for x in zip(*self.buf)]
+        self.buf, self.n = [], 0
+
+        order = np.argsort(cols[self.key], kind="mergesort")
+        cols = [col[order] for col in cols]
+
+        chunk = len(self.chunks)
+        filename = "chunk-%05d.npz" % chunk
+        np.savez_compressed(os.path.join(self.tmpdir,filename),
+                            **dict(zip(self.names,cols)))
+        self.chunks += [filename]
+
+        # row segments of each subject in this chunk
+        keys = cols[self.key]
+        sids, starts = np.unique(keys, return_index=True)
+        stops = list(starts[1:]) + [len(keys)]
+        for sid,start,stop in zip(sids,starts,stops):
+            sid, segment = unicode(sid), [chunk, int(start), int(stop)]
+            self.subjects[sid] = self.subjects.get(sid,[]) + [segment]
+
+        self.rows += len(keys)
+
+    def close(self):
+        '''Write the index and move the store into place. Returns the number
+        of rows written.
+        '''
+        self.flush()
+
+        index = {"version":STORE_VERSION, "key":self.names[self.key],
+                 "columns":zip(self.names,self.kinds), "chunks":self.chunks,
+                 "subjects":self.subjects, "rows":self.rows}
+        with open(os.path.join(self.tmpdir,"index.json"),"w") as f:
+            json.dump(index, f, sort_keys=True)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmpdir, self.path)
+
+        return self.rows
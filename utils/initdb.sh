@@ -7,11 +7,24 @@
 # @author	Jason Alan Fries 
 # @email 	jason-fries [at] stanford [dot] edu
 # 
-# USAGE: initdb.sh
+# USAGE: initdb.sh [-d | -u]
+#   -d  download datasets first
+#   -u  incremental update: only reload data sets whose files changed,
+#       also resumes an interrupted build
 #
 
 DBNAME="oai2";
 DATADIR="/tmp/"
+JOBS=1
+MANIFEST=$DATADIR/oai-manifest.json
+TSDIR=$DATADIR/oai-timeseries/
+METACACHE=$DATADIR/oai-metadata.pickle
+
+# postgres, or an embedded database file: duckdb | sqlite
+BACKEND=postgres
+if [ "$BACKEND" != "postgres" ]; then
+	DBNAME=$DATADIR/oai2.$BACKEND
+fi
 
 if [ "$1" == "-d" ]; then
 	# Make temp download directory
@@ -21,13 +34,27 @@ if [ "$1" == "-d" ]; then
 	python fetch-data.py -o $DATADIR/OAI/
 fi
 
-# Create database
-psql -c 'DROP DATABASE IF EXISTS '$DBNAME';'
-psql -c 'CREATE DATABASE '$DBNAME';'
+# Create database (fresh builds start with an empty manifest)
+if [ "$1" != "-u" ]; then
+	rm -f $MANIFEST
+	if [ "$BACKEND" == "postgres" ]; then
+		psql -c 'DROP DATABASE IF EXISTS '$DBNAME';'
+		psql -c 'CREATE DATABASE '$DBNAME';'
+	else
+		rm -f $DBNAME
+	fi
+fi
 
-# Create SQL table schema and data
-python dbimport/metadata.py -i ../data/VG_Variable_tables.bz2 > $DATADIR/oai-data.sql 
-python dbimport/createdb.py -i $DATADIR/OAI/ >> $DATADIR/oai-data.sql
+# Create and load metadata tables
+python dbimport/metadata.py -i ../data/VG_Variable_tables.bz2 -d $DBNAME -b $BACKEND \
+	-c $METACACHE --manifest $MANIFEST --report $DATADIR/oai-metadata-report.json
 
-# Load table schema and data
-psql -d $DBNAME -f $DATADIR/oai-data.sql
+# Create table schema and stream data directly into the database (COPY)
+# (AccelData is written to a time series store under $TSDIR)
+python dbimport/createdb.py -i $DATADIR/OAI/ -d $DBNAME -b $BACKEND -j $JOBS \
+	-t $TSDIR --manifest $MANIFEST --report $DATADIR/oai-import-report.json
+
+# Create secondary indexes and refresh table statistics
+if [ "$BACKEND" == "postgres" ]; then
+	python dbimport/indexdb.py -d $DBNAME
+fi